@@ -0,0 +1,408 @@
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import tracemalloc
+except ImportError:  # python2
+    tracemalloc = None
+
+import numpy as np
+
+from p23serialize import PreEncoder, PostDecoder, encode_bytes
+from p23serialize import binary
+from p23serialize.registry import (
+    default_encode_settings, default_decode_settings)
+
+'''
+Benchmarks for p23serialize.
+
+Run from the repository root:
+    python benchmarks.py [--json results.json]
+
+Point PYTHONPATH at another checkout to compare against an older version.
+With --json, the results of every benchmark are also written to that file,
+to compare runs of different versions.
+'''
+
+# Peak RSS is a process-wide high-water mark, so every memory measurement
+# runs in a fresh interpreter. ru_maxrss is not enough there: on Linux the
+# child reports at least the peak of the process that started it. VmHWM
+# belongs to the child's own address space.
+memory_script = '''
+import marshal, resource, sys
+from p23serialize import PreEncoder, PostDecoder
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss / 1024.  # bytes on macOS, kB everywhere else
+    return rss / 1024.
+
+n_records = int(sys.argv[1])
+stage = sys.argv[2]
+data = [[k, k * 0.5, None, [k, k + 1, k + 2], {k: None}]
+        for k in range(n_records)]
+if stage == 'prepare':
+    # Encoded input for the decode stage, written by a separate process so
+    # that encoding does not count towards the decoder's peak.
+    with open(sys.argv[3], 'wb') as f:
+        marshal.dump(PreEncoder().encode(data), f)
+    sys.exit()
+if stage == 'decode':
+    del data
+    with open(sys.argv[3], 'rb') as f:
+        encoded = marshal.load(f)
+    rss_before = peak_rss_mb()
+    decoded = PostDecoder().decode(encoded)
+else:
+    rss_before = peak_rss_mb()
+    encoded = PreEncoder().encode(data)
+rss_after = peak_rss_mb()
+print(rss_before, rss_after)
+'''
+
+
+def measure_peak_rss(n_records, stage):
+    # Run outside the repository so that PYTHONPATH decides which version of
+    # p23serialize gets imported ('python -c' puts the cwd first on sys.path)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,
+        PYTHONPATH=os.environ.get('PYTHONPATH', repo_dir))
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'encoded.marshal')
+    try:
+        if stage == 'decode':
+            subprocess.check_call([sys.executable, '-c', memory_script,
+                str(n_records), 'prepare', path], env=env, cwd=tmp_dir)
+        out = subprocess.check_output([sys.executable, '-c', memory_script,
+            str(n_records), stage, path], env=env, cwd=tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+    rss_before, rss_after = [float(_) for _ in out.split()]
+    return rss_before, rss_after
+
+
+# Returns (top_level, imported): the cumulative import times in microseconds
+# of the modules imported at the top level, and the names of all modules
+# imported, as reported by 'python -X importtime' (python 3.7+) for statement in
+# a fresh interpreter. Best of a few runs; .pyc files are written on the first
+# one, so later runs measure cached imports.
+def measure_import_time(statement, repeat = 3):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ,
+        PYTHONPATH=os.environ.get('PYTHONPATH', repo_dir))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    tmp_dir = tempfile.mkdtemp()
+    best = {}
+    imported = set()
+    try:
+        for _ in range(repeat):
+            proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                statement], env=env, cwd=tmp_dir, stderr=subprocess.PIPE)
+            err = proc.communicate()[1].decode('utf8')
+            if proc.returncode:
+                raise Exception('Import failed: %s' % err)
+            for line in err.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line:
+                    continue
+                _, cumulative, name = line.split('|')
+                imported.add(name.strip())
+                if name.startswith('  '):
+                    continue  # imported by another module
+                name = name.strip()
+                best[name] = min(best.get(name, int(cumulative)),
+                    int(cumulative))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return best, imported
+
+
+# Best of a few runs, in seconds
+def timeit(fn, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        fn()
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+# Peak memory allocated while running fn, in bytes (None without tracemalloc)
+def traced_peak(fn):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def json_dumps(obj):
+    return json.dumps(PreEncoder(default_encode_settings).encode(obj))
+
+
+def json_loads(payload):
+    return PostDecoder(default_decode_settings).decode(json.loads(payload))
+
+
+def binary_dumps(obj):
+    return binary.dumps(obj, default_encode_settings)
+
+
+def binary_loads(payload):
+    return binary.loads(payload, default_decode_settings)
+
+
+def workloads():
+    rng = np.random.RandomState(0)
+    deep = []
+    for _ in range(5000):
+        deep = [deep]
+    shared = list(range(10))
+    circular = [{'id': k} for k in range(20000)]
+    for k, node in enumerate(circular):
+        node['next'] = circular[(k + 1) % len(circular)]
+        node['shared'] = shared
+    n = 4 << 20
+    return [
+        ('deep nesting', deep),
+        ('wide dicts', [dict(('field%d' % j, j * k) for j in range(1000))
+            for k in range(100)]),
+        ('small strings', ['s%d' % k for k in range(100000)]),
+        ('tiny arrays', [rng.standard_normal(4) for _ in range(20000)]),
+        ('huge arrays', [rng.standard_normal(1 << 20) for _ in range(2)]),
+        ('shared graph', [shared] * 100000),
+        ('circular graph', circular),
+        ('bytes random', rng.bytes(n)),
+        ('bytes text', (b'lorem ipsum dolor sit amet ' * (n // 27 + 1))[:n]),
+        ('bytes zeros', bytes(bytearray(n))),
+    ]
+
+
+def run_benchmarks(json_path = None):
+    benchmarks = []
+    results = {}
+
+    def bench_workloads():
+        results['workloads'] = workload_results = []
+        for name, data in workloads():
+            encode = lambda: PreEncoder(default_encode_settings).encode(data)
+            encoded = encode()
+            decode = lambda: PostDecoder(default_decode_settings).decode(
+                encoded)
+            dumps = lambda: json.dumps(encode())
+            payload = dumps()
+            loads = lambda: PostDecoder(default_decode_settings).decode(
+                json.loads(payload))
+            result = {'name': name, 'slots': len(encoded),
+                'payload_bytes': len(payload)}
+            line = '  %-14s %7d slots %10d bytes' % (
+                name, len(encoded), len(payload))
+            for stage, fn in (('encode', encode), ('decode', decode),
+                    ('dumps', dumps), ('loads', loads)):
+                t = timeit(fn)
+                result[stage] = {'seconds': t, 'ops_per_s': 1 / t,
+                    'mb_per_s': len(payload) / t / 1e6,
+                    'peak_bytes': traced_peak(fn)}
+                line += '  %s %7.1f ms' % (stage, t * 1e3)
+            workload_results.append(result)
+            print(line)
+    benchmarks.append((bench_workloads, 'Workloads: encode/decode and json round trip'))
+
+    def bench_memory():
+        n_records = 200000
+        results['memory'] = memory_results = []
+        for stage in ('encode', 'decode'):
+            rss_before, rss_after = measure_peak_rss(n_records, stage)
+            memory_results.append({'stage': stage, 'records': n_records,
+                'peak_rss_mb_before': rss_before,
+                'peak_rss_mb_after': rss_after})
+            print('  %s %d records: peak RSS %.1f MB -> %.1f MB (+%.1f MB)' % (
+                stage, n_records, rss_before, rss_after,
+                rss_after - rss_before))
+    benchmarks.append((bench_memory, 'Peak RSS of the slot table'))
+
+    def bench_binary():
+        rng = np.random.RandomState(0)
+        workloads = [
+            ('arrays', [rng.standard_normal(1 << 17) for _ in range(8)]),
+            ('bytes blobs', [rng.bytes(1 << 20) for _ in range(4)]),
+            ('records', [{'id': k, 'name': 'user%d' % k, 'score': k * 0.5,
+                'tags': ('a', 'b')} for k in range(20000)]),
+        ]
+        results['binary'] = binary_results = []
+        for name, data in workloads:
+            for backend, dumps, loads in (
+                    ('json', json_dumps, json_loads),
+                    ('binary', binary_dumps, binary_loads)):
+                payload = dumps(data)
+                t_dumps = timeit(lambda: dumps(data))
+                t_loads = timeit(lambda: loads(payload))
+                binary_results.append({'name': name, 'backend': backend,
+                    'payload_bytes': len(payload), 'dumps_seconds': t_dumps,
+                    'loads_seconds': t_loads})
+                print('  %-12s %-6s %9d bytes  dumps %7.1f ms  '
+                    'loads %7.1f ms' % (name, backend, len(payload),
+                    t_dumps * 1e3, t_loads * 1e3))
+    benchmarks.append((bench_binary, 'Binary backend vs json'))
+
+    def bench_bytes():
+        rng = np.random.RandomState(0)
+        n = 8 << 20
+        blobs = [
+            ('random', rng.bytes(n)),
+            ('text', (b'lorem ipsum dolor sit amet ' * (n // 27 + 1))[:n]),
+            ('sparse', np.where(rng.random_sample(n) < 0.9, 0,
+                rng.randint(0, 256, n)).astype(np.uint8).tobytes()),
+        ]
+        results['bytes'] = bytes_results = []
+        for name, blob in blobs:
+            for strategy in ('exact', 'estimate', 'base64'):
+                t = timeit(lambda: encode_bytes(blob, strategy))
+                encoding = encode_bytes(blob, strategy)[0][0]
+                bytes_results.append({'name': name, 'strategy': strategy,
+                    'seconds': t, 'mb_per_s': n / t / 1e6,
+                    'encoding': encoding})
+                print('  %-7s %-9s %7.1f ms  %6.0f MB/s  (encoding %d)' % (
+                    name, strategy, t * 1e3, n / t / 1e6, encoding))
+    benchmarks.append((bench_bytes, 'Bytes encoding strategies'))
+
+    def bench_compact_dicts():
+        data = [dict(('field%d' % j, j * k) for j in range(500))
+            for k in range(200)]
+        rows = [{'id': k, 'name': 'user%d' % k, 'score': k * 0.5}
+            for k in range(100000)]
+        results['dict_layouts'] = layout_results = []
+        for name, data in (('wide', data), ('rows', rows)):
+            for option in ('default', 'compact_dicts', 'dict_templates'):
+                options = {} if option == 'default' else {option: True}
+                encoder = lambda: PreEncoder(**options).encode(data)
+                encoded = encoder()
+                t_encode = timeit(encoder)
+                t_decode = timeit(lambda: PostDecoder().decode(encoded))
+                layout_results.append({'name': name, 'layout': option,
+                    'slots': len(encoded), 'encode_seconds': t_encode,
+                    'decode_seconds': t_decode})
+                print('  %-4s %-14s %7d slots  encode %6.1f ms  '
+                    'decode %6.1f ms' % (name, option, len(encoded),
+                    t_encode * 1e3, t_decode * 1e3))
+    benchmarks.append((bench_compact_dicts, 'Wide dicts and rows, dict layouts'))
+
+    def bench_packed_lists():
+        rng = np.random.RandomState(0)
+        data = [rng.standard_normal(1 << 20).tolist(),
+            rng.randint(0, 1000, 1 << 20).tolist()]
+        results['packed_lists'] = packed_results = []
+        for name, items in (('floats', data[0]), ('ints', data[1])):
+            for packed_lists in (False, True):
+                encoder = lambda: PreEncoder(
+                    packed_lists=packed_lists).encode(items)
+                encoded = encoder()
+                payload = json.dumps(encoded)
+                t_encode = timeit(encoder)
+                t_decode = timeit(lambda: PostDecoder().decode(encoded))
+                packed_results.append({'name': name,
+                    'packed_lists': packed_lists, 'slots': len(encoded),
+                    'payload_bytes': len(payload), 'encode_seconds': t_encode,
+                    'decode_seconds': t_decode})
+                print('  %-6s packed_lists=%-5s %9d bytes  encode %6.1f ms  '
+                    'decode %6.1f ms' % (name, packed_lists, len(payload),
+                    t_encode * 1e3, t_decode * 1e3))
+    benchmarks.append((bench_packed_lists, 'Numeric lists, packed or not'))
+
+    def bench_string_formats():
+        data = [['user%d' % k, u'name \u20ac %d' % k, 'x' * (k % 100),
+            b'key%d' % k] for k in range(100000)]
+        results['string_formats'] = format_results = []
+        for string_format in ('prefixed', 'native'):
+            encoder = lambda: PreEncoder(
+                string_format=string_format).encode(data)
+            encoded = encoder()
+            decoder = lambda: PostDecoder(
+                string_format=string_format).decode(encoded)
+            t_encode = timeit(encoder)
+            t_decode = timeit(decoder)
+            peak = traced_peak(decoder)
+            format_results.append({'string_format': string_format,
+                'encode_seconds': t_encode, 'decode_seconds': t_decode,
+                'decode_peak_bytes': peak})
+            print('  %-8s encode %6.1f ms  decode %6.1f ms  peak %5.1f MB' % (
+                string_format, t_encode * 1e3, t_decode * 1e3,
+                (peak or 0) / 1e6))
+    benchmarks.append((bench_string_formats, 'String formats'))
+
+    def bench_parallel():
+        try:
+            from p23serialize import parallel
+        except ImportError:
+            print('  needs concurrent.futures')
+            return
+        data = [{'id': k, 'name': 'user%d' % k, 'score': k * 0.5,
+            'tags': ['a', 'b', k]} for k in range(100000)]
+        encoded = PreEncoder().encode(data)
+        results['parallel'] = parallel_results = {
+            'cpus': os.cpu_count() or 1, 'runs': []}
+        for name, encode, decode in (
+                ('serial', lambda: PreEncoder().encode(data),
+                    lambda: PostDecoder().decode(encoded)),
+                ('parallel', lambda: parallel.encode(data),
+                    lambda: parallel.decode(encoded)),
+                ('unchecked', lambda: parallel.encode(data, check_shared=False),
+                    lambda: parallel.decode(encoded, check_shared=False))):
+            t_encode = timeit(encode)
+            t_decode = timeit(decode)
+            parallel_results['runs'].append({'name': name,
+                'encode_seconds': t_encode, 'decode_seconds': t_decode})
+            print('  %-9s encode %7.1f ms  decode %7.1f ms' % (
+                name, t_encode * 1e3, t_decode * 1e3))
+        print('  (%d cpus)' % (os.cpu_count() or 1))
+    benchmarks.append((bench_parallel, 'Parallel encode/decode'))
+
+    def bench_import_time():
+        if sys.version_info < (3, 7):
+            print('  needs python 3.7+ (-X importtime)')
+            return
+        startup = measure_import_time('pass')[0]
+        results['import_time'] = import_results = {}
+        for statement in ('import p23serialize',
+                'from p23serialize import registry', 'import numpy'):
+            times, imported = measure_import_time(statement)
+            # Only what the statement imports, not the interpreter's startup
+            t = sum(t for name, t in times.items() if not name in startup)
+            import_results[statement] = {'microseconds': t,
+                'numpy_imported': 'numpy' in imported}
+            print('  %-34s %7.1f ms  (numpy imported: %s)' % (
+                statement, t / 1e3, 'numpy' in imported))
+    benchmarks.append((bench_import_time, 'Import time (python -X importtime)'))
+
+    for bench, bench_description in benchmarks:
+        print('Benchmark:', bench_description)
+        bench()
+
+    if json_path is not None:
+        results['python'] = sys.version
+        results['numpy'] = np.__version__
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent = 1, sort_keys = True)
+
+if __name__ == '__main__':
+    json_path = None
+    if '--json' in sys.argv:
+        json_path = sys.argv[sys.argv.index('--json') + 1]
+    run_benchmarks(json_path)
@@ -1,11 +1,9 @@
 
 from __future__ import print_function
 
+import importlib
+import os
 import sys
-from base64 import b64encode, b64decode
-import re
-import numpy as np
-import json
 #import msgpack
 
 
@@ -14,6 +12,49 @@ import json
 class NeverHappens(Exception): pass
 
 
+# Stands in for a module that is only imported on first attribute access.
+# Importing p23serialize does not import numpy: code paths that need it
+# (ndarray codecs, packed lists) import it when they are first used.
+class LazyModule():
+
+    def __init__(self, name):
+        self._module_name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self._module_name), attr)
+        setattr(self, attr, value)  # found without __getattr__ next time
+        return value
+
+
+np = LazyModule('numpy')
+base64 = LazyModule('base64')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+zlib = LazyModule('zlib')
+bz2 = LazyModule('bz2')
+lzma = LazyModule('lzma')
+
+
+# Whether module name can be imported, without importing it where possible
+def module_available(name):
+    try:
+        from importlib.util import find_spec
+    except ImportError:  # python2: import it to find out
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            return False
+        return True
+    return find_spec(name) is not None
+
+
+# base85 needs python 3
+def b85_functions():
+    if not hasattr(base64, 'b85encode'):
+        raise Exception('base85 needs python 3')
+    return base64.b85encode, base64.b85decode
+
+
 try:
     unicode
     # Note: in python2:  str == bytes
@@ -90,6 +131,32 @@ elif str_mode == 'unicode':  # typically python3
 else:  # str_mode *cannot* be something else
     raise NeverHappens
 
+# In-band copy of a buffer (memoryview) handed out by an encoder
+def encode_buffer(buf):
+    return encode_str(buf.tobytes())
+
+# String formats of the slot table (PreEncoder's string_format):
+# - 'prefixed': every string slot is 'b' or 'u' followed by the bytes (as
+#   latin1 text) or the text, the same in python 2 and 3
+# - 'native': string slots hold the text itself, or the bytes as latin1 text.
+#   The slot table gets one more slot at the end: the list of the bytes
+#   slots. Text passes through without copies in both directions.
+string_formats = ('prefixed', 'native')
+
+def encode_native_str(s):
+    if isinstance(s, bytes):
+        return s.decode('latin1')
+    return s
+
+def encode_native_buffer(buf):
+    return buf.tobytes().decode('latin1')
+
+# Text slots only; bytes slots are decoded up front, see PostDecoder.decode
+def decode_native_str(s):
+    if isinstance(s, bytes):
+        return s.decode('utf8')
+    return s
+
 # Update dictionary keys so that they are all of the native string type
 def force_str_type0_keys(dct):
     for key in dct:
@@ -123,47 +190,269 @@ Decoder functions:
 '''
 
 
-class Slot():
-    def __init__(self, obj, idx):
-        self.raw = obj
-        self.encoded = None
-        self.done = False
-        self.idx = idx
+# Type-exact signature of a (possibly nested) tuple's elements, so that
+# e.g. (1,), (1.0,) and (True,) or (0.0,) and (-0.0,) are not merged.
+# Frozenset items are paired with their own signature, since an equal set
+# can hold the same types for other values (e.g. {True, 0} and {1, False}).
+def value_signature(obj):
+    t = type(obj)
+    if t is tuple:
+        return tuple([value_signature(item) for item in obj])
+    elif t is frozenset:
+        return frozenset([(item, value_signature(item)) for item in obj])
+    elif t is float:
+        return obj.hex()
+    return t
+
+
+# Key under which equal immutable values are interned, None if obj cannot be
+# interned. The type is part of the key since e.g. 'a' == u'a' in python2.
+def intern_key(obj):
+    t = type(obj)
+    if t is tuple:
+        try:
+            hash(obj)
+        except TypeError:
+            return None
+        return (t, obj, value_signature(obj))
+    elif 'numpy' in sys.modules and t is np.ndarray:
+        if obj.flags.writeable or obj.dtype.hasobject:
+            return None
+        data = np.ascontiguousarray(obj).reshape(-1).view(np.uint8)
+        return (t, obj.dtype, obj.shape, hashlib.sha1(data).digest())
+    return (t, obj)
+
+
+# What PreEncoder does with an object, by type (see resolve_dispatch)
+KIND_STR = 0
+KIND_LIST = 1
+KIND_DICT = 2
+KIND_BUFFER = 3
+KIND_SCALAR = 4
+builtin_kinds = {
+    list: KIND_LIST,
+    dict: KIND_DICT,
+    memoryview: KIND_BUFFER,
+}
+for _t in str_types:
+    builtin_kinds[_t] = KIND_STR
+del _t
+
+# numpy scalar types walked as the basic type they hold (KIND_SCALAR). They
+# join builtin_kinds once numpy has been imported, see add_numpy_kinds.
+numpy_scalar_types = ('bool_', 'integer', 'floating')
+
+
+# numpy objects only exist once numpy is imported, so it is enough to check
+# for it whenever a new type is resolved.
+def add_numpy_kinds():
+    global numpy_scalar_types
+    if numpy_scalar_types and 'numpy' in sys.modules:
+        for name in numpy_scalar_types:
+            builtin_kinds[getattr(np, name)] = KIND_SCALAR
+        numpy_scalar_types = ()
+
+
+# Tag of the compact dict layout, see PreEncoder's compact_dicts
+compact_dict_tag = 'py/{}'
+
+# Tag of dicts encoded against a template, see PreEncoder's dict_templates
+template_dict_tag = 'py/{*}'
+
+# Packed lists (see PreEncoder's packed_lists) are encoded as one slot
+# ['py/[]', code, [buffer slot]]: the items as little-endian packed_dtypes[code]
+# (ints in the narrowest dtype that holds them all) in an out-of-band buffer,
+# or in-band as a buffer (binary backend) or base64 text (json). Raw bytes
+# as latin1 text would make the json bigger than plain lists.
+packed_list_tag = 'py/[]'
+packed_dtypes = ('<f8', '<i8', '<i1', '<i2', '<i4')
+packed_list_min = 16  # shorter lists are not packed
+
+
+# Code of the narrowest packed int dtype for values in [lo, hi]
+def packed_int_code(lo, hi):
+    for code in (2, 3, 4):
+        info = np.iinfo(packed_dtypes[code])
+        if info.min <= lo and hi <= info.max:
+            return code
+    return 1
+
+
+# Returns (code, buffer) for a list of only floats or only ints (exact types,
+# so bools etc. keep their type), None for any other list.
+def pack_list(obj):
+    t = type(obj[0])
+    if not (t is float or t is int):
+        return None
+    # Cheap sample first, so mixed lists rarely pay for the full check
+    step = max(len(obj) // 8, 1)
+    for item in obj[::step]:
+        if type(item) is not t:
+            return None
+    if len(set(map(type, obj))) != 1:
+        return None
+    code = 0 if t is float else 1
+    try:
+        packed = np.array(obj, dtype = packed_dtypes[code])
+    except OverflowError:
+        return None  # ints beyond 64 bits
+    if code == 1:
+        code = packed_int_code(packed.min(), packed.max())
+        packed = packed.astype(packed_dtypes[code])
+    return code, memoryview(packed.view(np.uint8))
+
+
+# data is the buffer, or its base64 text
+def unpack_list(code, data):
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = base64.b64decode(data)
+    return np.frombuffer(data, dtype = packed_dtypes[code]).tolist()
+
 
 class PreEncoder():
 
     # encoders is a dictionary type:(name, encoder_function)
-    def __init__(self, encoders = {}):
+    # buffer_callback works like pickle protocol 5's: it is called with every
+    # memoryview produced by an encoder (e.g. ndarray data). If it returns a
+    # false value the buffer is out-of-band: the caller keeps it and the slot
+    # table only stores its index (see PostDecoder's buffers argument).
+    # Otherwise, or without a callback, the data is copied in-band as bytes.
+    # intern_values makes equal immutable values share one slot even when
+    # they are distinct objects: True for strings and tuples, or a tuple of
+    # types to intern, which may include np.ndarray (read-only arrays only).
+    # The intern table is emptied whenever it reaches intern_max entries.
+    # compact_dicts encodes dicts as one slot ['py/{}', key0, value0, ...]
+    # with keys and values stored like list items, instead of a ['py/', ...]
+    # slot that points at one [key, value] list slot per entry.
+    # dict_templates encodes every non-empty dict as one slot
+    # ['py/{*}', [shape slot], value0, value1, ...] with the values stored
+    # like list items. The shape slot is a list of the keys, shared by all
+    # dicts with the same keys (same order and types).
+    # packed_lists encodes lists of at least packed_list_min items that are
+    # all floats or all ints as one packed buffer (see pack_list), stored as
+    # base64 text when it would be in-band text.
+    # stats is an EncodeStats object (see stats.py) to collect statistics in.
+    # string_format is one of string_formats; the decoder has to use the
+    # same one. Streams and sessions need the default 'prefixed' format.
+    def __init__(self, encoders = {}, buffer_callback = None,
+            intern_values = False, intern_max = 1 << 16,
+            compact_dicts = False, dict_templates = False,
+            packed_lists = False, stats = None, string_format = 'prefixed'):
         # TODO: sanity check: encoders keys must be the native string type
-        self.ids = {}  # dictionary of id:id_new for recurring items in data
-        self.slots = []
+        self.compact_dicts = compact_dicts
+        self.dict_templates = dict_templates
+        self.templates = {}  # (keys, key types):shape list, see dict_templates
+        self.packed_lists = packed_lists
+        self.buffer_callback = buffer_callback
+        if intern_values is True:
+            intern_values = str_types + (tuple,)
+        self.intern_types = frozenset(intern_values or ())
+        self.intern_max = intern_max
+        # intern_key(obj):slot index, None when interning is off
+        self.interned = {} if self.intern_types else None
+        self.n_buffers = 0  # number of out-of-band buffers handed out
+        self.ids = {}  # dictionary of id:slot index for recurring items in data
+        # The slot table is kept as flat arrays instead of one object per slot:
+        self.encoded = []  # encoded value of every slot, indexed by slot
+        self.raws = []  # walked objects, keeps them alive so id()s stay unique
         self.encoders = encoders   # name:type pairs
         self.encoders_types = tuple(encoders.keys())
+        self.encoders_by_name = any(
+            isinstance(key, str_types) for key in encoders)
+        self.dispatch = {}  # type:kind cache, see resolve_dispatch
         # basictypes: don't walk these types:
         self.basictypes = [int, float, type(None)]
         self.basictypes = tuple(self.basictypes)
+        # How strings and in-band buffers are put into the slot table.
+        # Backends with native bytes/str types replace these (see binary.py).
+        self.encode_str = encode_str
+        self.encode_buffer = encode_buffer
+        self.bytes_slots = None  # indices of the bytes slots, 'native' only
+        if string_format == 'native':
+            self.encode_str = encode_native_str
+            self.encode_buffer = encode_native_buffer
+            self.bytes_slots = []
+        elif string_format != 'prefixed':
+            raise Exception('Unknown string format %r' % (string_format,))
+        # Streaming hook (see stream.py): when set, emit(record) is called
+        # for every slot as soon as its encoding is final.
+        self.emit = None
+        self.open_frames = {}  # idx:frame of slots still being walked
+        self.declared = {}  # idx:head of open slots that were referenced
+        self.stats = stats
+        if stats is not None:
+            stats.attach(self)
 
+    # Returns (idx, is_new) for the slot of obj. New slots still have to be
+    # walked (see enter).
     def obj_slot(self, obj):
         if isinstance(obj, self.basictypes):
-            # Basic types get a slot, but they're already done then. Also,
-            # basic types don't have an associated id(x).
-            slot = Slot(obj, len(self.slots))
-            slot.done = True
-            slot.encoded = obj
-            self.slots.append(slot)
-            return slot
+            # Basic types are stored straight in the slot table. They need no
+            # bookkeeping because they don't have an associated id(x).
+            self.encoded.append(obj)
+            idx = len(self.encoded) - 1
+            if self.emit is not None:
+                self.finish(idx)
+            return idx, False
         obj_id = id(obj)
-        if obj_id in self.ids:
-            idx = self.ids[obj_id]
-            return self.slots[idx]
-        slot = Slot(obj, len(self.slots))
-        self.ids[obj_id] = len(self.slots)
-        self.slots.append(slot)
-        return slot
-
-    def apply_encoders(self, obj):
-        encoder_name = self.encoders[type(obj)][0]
-        encoder_func = self.encoders[type(obj)][1]
+        idx = self.ids.get(obj_id)
+        if idx is None and self.interned is not None:
+            idx = self.intern_slot(obj, len(self.encoded))
+        if idx is not None:
+            return idx, False
+        idx = len(self.encoded)
+        self.ids[obj_id] = idx
+        self.encoded.append(None)
+        self.raws.append(obj)
+        return idx, True
+
+    # Returns the slot of a value equal to obj, if one was interned. If not,
+    # obj is interned as the value of slot new_idx and None is returned.
+    def intern_slot(self, obj, new_idx):
+        if not type(obj) in self.intern_types:
+            return None
+        key = intern_key(obj)
+        if key is None:
+            return None
+        idx = self.interned.get(key)
+        if idx is None:
+            if len(self.interned) >= self.intern_max:
+                self.interned.clear()
+            self.interned[key] = new_idx
+        return idx
+
+    # How to walk objects of type t: one of the KIND_* constants, or the
+    # (name, encoder_function) pair from encoders. Found via t's MRO, so
+    # subclasses are handled like their closest registered/builtin base, and
+    # cached per type. encoders may be keyed by 'module.name' strings instead
+    # of types, so registering a type does not import its module.
+    def resolve_dispatch(self, t):
+        add_numpy_kinds()
+        kind = None
+        for cls in getattr(t, '__mro__', (t,)):
+            if cls in self.encoders:
+                kind = self.encoders[cls]
+                break
+            if self.encoders_by_name:
+                name = '%s.%s' % (cls.__module__, cls.__name__)
+                if name in self.encoders:
+                    kind = self.encoders[name]
+                    break
+            if cls in builtin_kinds:
+                kind = builtin_kinds[cls]
+                break
+        if kind is None:
+            raise NeverHappens('Cannot encode type %r' % (t,))
+        self.dispatch[t] = kind
+        return kind
+
+    def apply_encoders(self, obj, encoder = None):
+        if encoder is None:
+            encoder = self.dispatch.get(type(obj))
+            if encoder is None:
+                encoder = self.resolve_dispatch(type(obj))
+        encoder_name = encoder[0]
+        encoder_func = encoder[1]
         data_init, data_final = encoder_func(obj)
         # TODO: sanity check: encode_name MUST be native str type
         # (This should already be done when setting up the PreEncoder class)
@@ -173,61 +462,187 @@ class PreEncoder():
             encoder_params.append(data_final)
         return encoding_tag, encoder_params
 
+    # Start walking obj, which was just given slot idx. Strings are finished
+    # immediately (returns False). Containers get their encoded skeleton and
+    # a frame is pushed onto the work stack (returns True).
+    # A frame is [encoded, children, offset, is_list, next_child, idx].
+    def enter(self, idx, obj, stack):
+        kind = self.dispatch.get(type(obj))
+        if kind is None:
+            kind = self.resolve_dispatch(type(obj))
+        if kind == KIND_STR:
+            self.encoded[idx] = self.encode_str(obj)
+            if self.bytes_slots is not None and isinstance(obj, bytes):
+                self.bytes_slots.append(idx)
+        elif kind == KIND_LIST:
+            packed = None
+            if self.packed_lists and len(obj) >= packed_list_min:
+                packed = pack_list(obj)
+            if packed is None:
+                encoded = [None] * len(obj)
+                frame = [encoded, obj, 0, True, 0, idx]
+            else:
+                code, buf = packed
+                if self.buffer_callback is None and self.encode_buffer in (
+                        encode_buffer, encode_native_buffer):
+                    # In-band text: base64 instead of latin1
+                    buf = base64.b64encode(buf).decode('ascii')
+                encoded = [packed_list_tag, code, None]
+                frame = [encoded, [buf], 2, True, 0, idx]
+        elif kind == KIND_DICT:
+            if self.dict_templates and obj:
+                keys = tuple(obj)
+                template_key = (keys, tuple(map(value_signature, keys)))
+                shape = self.templates.get(template_key)
+                if shape is None:
+                    shape = list(keys)
+                    self.templates[template_key] = shape
+                encoded = [template_dict_tag] + [None] * (len(keys) + 1)
+                children = [shape]
+                children.extend(obj.values())
+                frame = [encoded, children, 1, True, 0, idx]
+            elif self.compact_dicts:
+                encoded = [compact_dict_tag] + [None] * (2 * len(obj))
+                kv_items = [item for kv in obj.items() for item in kv]
+                frame = [encoded, kv_items, 1, True, 0, idx]
+            else:
+                encoded = ['py/'] + [None] * len(obj)
+                kv_objs = [[key, obj[key]] for key in obj.keys()]
+                frame = [encoded, kv_objs, 1, False, 0, idx]
+        elif kind == KIND_BUFFER:
+            if self.buffer_callback is None or self.buffer_callback(obj):
+                self.encoded[idx] = self.encode_buffer(obj)
+                if self.bytes_slots is not None:
+                    self.bytes_slots.append(idx)
+            else:
+                buffer_idx, _ = self.obj_slot(self.n_buffers)
+                self.n_buffers += 1
+                self.encoded[idx] = ['py/buffer', buffer_idx]
+        elif kind == KIND_SCALAR:
+            # numpy scalars that aren't basic types already (e.g. np.int64)
+            self.encoded[idx] = obj.item()
+            if not isinstance(self.encoded[idx], self.basictypes):
+                raise NeverHappens('Cannot encode type %r' % (type(obj),))
+        else:
+            encoding_tag, encoder_params = self.apply_encoders(obj, kind)
+            # encoder_params is a list with length 1 or 2
+            encoded = [encoding_tag] + [None] * len(encoder_params)
+            frame = [encoded, encoder_params, 1, False, 0, idx]
+        if self.encoded[idx] is not None:
+            # Finished already
+            if self.emit is not None:
+                self.finish(idx)
+            return False
+        self.encoded[idx] = encoded
+        stack.append(frame)
+        if self.emit is not None:
+            self.open_frames[idx] = frame
+        return True
+
+    # Streaming only: slot idx is final, send it out and forget its encoding.
+    def finish(self, idx):
+        self.emit([idx, self.encoded[idx]])
+        self.encoded[idx] = None
+        if idx in self.open_frames:
+            del self.open_frames[idx]
+            self.declared.pop(idx, None)
+
+    # Streaming only: slot idx is referenced while it is still being walked
+    # (a circular reference), so its record will arrive after the reference.
+    # Send a forward declaration telling the decoder what to create for it
+    # up front: 'list', 'dict', or for custom objects [tag, init_idx] once
+    # the init params are done (None before that, like PostDecoder.walk).
+    def declare(self, idx):
+        frame = self.open_frames.get(idx)
+        if frame is None:
+            return  # not open, i.e. the record was emitted already
+        encoded = frame[0]
+        if frame[2] == 0:
+            head = 'list'
+        elif encoded[0] in ('py/', compact_dict_tag, template_dict_tag):
+            head = 'dict'
+        elif frame[4] >= 2:
+            head = encoded[:2]
+        else:
+            head = None
+        if idx in self.declared and self.declared[idx] == head:
+            return
+        self.declared[idx] = head
+        self.emit(['fwd', idx, head])
+
+    # Walk the object graph depth-first with an explicit work stack instead of
+    # recursion, so nesting depth is only limited by memory. Slots are
+    # numbered in the order they are first reached (pre-order), i.e. the same
+    # numbering a recursive walk produces. Returns the slot index of obj.
     def walk(self, obj):
-        slot = self.obj_slot(obj)
-        if not slot.done:
-            slot.done = True  # Don't have to walk it again, because we'll do it now
-            if isinstance(obj, str_types):
-                slot.encoded = encode_str(obj)
-            elif isinstance(obj, list):
-                subslots = [None] * len(obj)  # only needed for debugging
-                slot.encoded = [None] * len(obj)
-                for k, item in enumerate(obj):
-                    if isinstance(item, self.basictypes):
-                        slot.encoded[k] = item
+        root, is_new = self.obj_slot(obj)
+        if not is_new:
+            return root
+        basictypes = self.basictypes
+        ids = self.ids
+        interned = self.interned
+        slots_encoded = self.encoded
+        raws = self.raws
+        stack = []
+        self.enter(root, obj, stack)
+        while stack:
+            frame = stack[-1]
+            encoded, children, offset, is_list, k, _ = frame
+            n = len(children)
+            while k < n:
+                item = children[k]
+                k += 1
+                if isinstance(item, basictypes):
+                    if is_list:
+                        encoded[offset + k - 1] = item
                     else:
-                        subslot = self.walk(item)
-                        subslots[k] = subslot
-                        slot.encoded[k] = [subslot.idx]
-            elif isinstance(obj, dict):
-                subslots = [None] * len(obj)
-                slot.encoded = ['py/'] + [None] * len(obj)
-                for k, key in enumerate(obj.keys()):
-                    kv_obj = [key, obj[key]]
-                    subslot = self.walk(kv_obj)
-                    subslots[k] = subslot
-                    slot.encoded[k + 1] = subslot.idx
-            elif isinstance(obj, self.encoders_types):
-                encoding_tag, encoder_params = self.apply_encoders(obj)
-                # encoder_params is a list with length 1 or 2
-                params_slots = [self.walk(param) for param in encoder_params]
-                params_slots = [param_slot.idx for param_slot in params_slots]
-                slot.encoded = [encoding_tag] + params_slots
+                        encoded[offset + k - 1] = len(slots_encoded)
+                        slots_encoded.append(item)
+                        if self.emit is not None:
+                            self.finish(len(slots_encoded) - 1)
+                    continue
+                # Inlined obj_slot
+                obj_id = id(item)
+                idx = ids.get(obj_id)
+                if idx is None and interned is not None:
+                    idx = self.intern_slot(item, len(slots_encoded))
+                is_new = idx is None
+                if is_new:
+                    idx = len(slots_encoded)
+                    ids[obj_id] = idx
+                    slots_encoded.append(None)
+                    raws.append(item)
+                if is_list:
+                    encoded[offset + k - 1] = [idx]
+                else:
+                    encoded[offset + k - 1] = idx
+                if is_new:
+                    frame[4] = k
+                    if self.enter(idx, item, stack):
+                        break  # descend first, resume this frame afterwards
+                elif self.emit is not None:
+                    self.declare(idx)
             else:
-                raise NeverHappens
-        return slot
+                stack.pop()
+                if self.emit is not None:
+                    self.finish(frame[5])
+        return root
 
     def encode(self, obj):
         self.walk(obj)
-        return [slot.encoded for slot in self.slots]
+        if self.bytes_slots is not None:
+            self.encoded.append(self.bytes_slots)
+        return self.encoded
 
 
-if str_mode == 'bytes':
-    re_deserializer0 = re.compile('py/(.*)')
-    re_deserializer1 = re.compile(u'py/(.*)')
-    def deserializer_match(s):
-        if isinstance(s, bytes):
-            return re_deserializer0.match(s)
-        else:
-            return re_deserializer1.match(s)
-else:  # str_mode == 'unicode'
-    re_deserializer0 = re.compile('py/(.*)')
-    re_deserializer1 = re.compile(b'py/(.*)')
-    def deserializer_match(s):
-        if isinstance(s, bytes):
-            return re_deserializer1.match(s)
-        else:
-            return re_deserializer0.match(s)
+# Returns the name of tag 'py/<name>' (native str), None if s is no tag
+def deserializer_name(s):
+    if isinstance(s, bytes):
+        if s.startswith(b'py/'):
+            return force_str_type0(s[3:])
+    elif s.startswith(u'py/'):
+        return force_str_type0(s[3:])
+    return None
 
 
 # TODO:
@@ -236,24 +651,111 @@ else:  # str_mode == 'unicode'
 # TODO: How does future.unicode_literals affect this??
 
 
+# Kinds of work-stack frames used by PostDecoder.walk
+FRAME_LIST = 0
+FRAME_DICT = 1
+FRAME_CUSTOM = 2
+FRAME_COMPACT_DICT = 3
+FRAME_PACKED_LIST = 4
+FRAME_TEMPLATE_DICT = 5
+
+# Returned by calculate_deserializer for the compact dict layout
+COMPACT_DICT = 'compact dict'
+# Returned by calculate_deserializer for packed lists
+PACKED_LIST = 'packed list'
+# Returned by calculate_deserializer for dicts encoded against a template
+TEMPLATE_DICT = 'template dict'
+
+# calculate_deserializer result for plain lists
+plain_list_deserializer = (None, None, None)
+
+
 class PostDecoder():
 
     # decoders is a dictionary name:(decoder_function)
-    def __init__(self, decoders = {}):
-        self.slots = []
+    # buffers is the sequence of out-of-band buffers collected through
+    # PreEncoder's buffer_callback. Decoders receive these objects as is, so
+    # e.g. ndarrays become views onto them.
+    # stats is a DecodeStats object (see stats.py) to collect statistics in.
+    # string_format is the one the slot table was encoded with (see
+    # PreEncoder).
+    def __init__(self, decoders = {}, buffers = None, stats = None,
+            string_format = 'prefixed'):
+        # Slot table as flat arrays, see decode
+        self.encoded = []
+        self.raws = []
+        self.done = bytearray()
         self.decoders = decoders   # name:(object_creation_fn, object_configure_fn) pairs
+        if buffers is not None:
+            self.buffers = list(buffers)
+            self.decoders = dict(decoders)
+            self.decoders['buffer'] = (self.get_buffer, None)
         self.decoders_names = tuple(decoders.keys())
         self.basictypes = [int, float, type(None)]  # don't walk these types
         self.basictypes = tuple(self.basictypes)
+        self.decode_str = decode_str  # see PreEncoder.encode_str
+        if string_format == 'native':
+            self.decode_str = decode_native_str
+        elif string_format != 'prefixed':
+            raise Exception('Unknown string format %r' % (string_format,))
+        self.string_format = string_format
+        self.tags = self.build_tag_table()
+        # Per-slot calculate_deserializer results of the last encoded list,
+        # reused when that same list is decoded again (so it must not be
+        # modified in between).
+        self.deserializers_for = None
+        self.deserializers = []
+        self.stats = stats
+        if stats is not None:
+            stats.attach(self)
+
+    # Maps every tag, in both its bytes and unicode spelling, to what
+    # calculate_deserializer returns for it.
+    def build_tag_table(self):
+        tags = {}
+        def add(tag, deserializer):
+            tags[tag] = deserializer
+            if isinstance(tag, bytes):
+                tags[tag.decode('utf8')] = deserializer
+            else:
+                tags[tag.encode('utf8')] = deserializer
+        add('py/', (dict, None, None))
+        add(compact_dict_tag, (COMPACT_DICT, None, None))
+        add(packed_list_tag, (PACKED_LIST, None, None))
+        add(template_dict_tag, (TEMPLATE_DICT, None, None))
+        for name, (decoder_init_fn, decoder_final_fn) in self.decoders.items():
+            add('py/' + force_str_type0(name),
+                (decoder_init_fn, decoder_final_fn, None))
+        return tags
 
     def decode(self, encoded_list):
-        self.slots = [None] * len(encoded_list)
-        for k, encoded in enumerate(encoded_list):
-            slot = Slot(None, k)
-            slot.encoded = encoded
-            self.slots[k] = slot
-        self.walk(self.slots[0])
-        return self.slots[0].raw
+        # encoded_list is used as is; decoded objects and the done flags are
+        # kept in arrays parallel to it.
+        self.encoded = encoded_list
+        self.raws = [None] * len(encoded_list)
+        self.done = bytearray(len(encoded_list))
+        if not (self.deserializers_for is encoded_list
+                and len(self.deserializers) == len(encoded_list)):
+            self.deserializers_for = encoded_list
+            self.deserializers = [None] * len(encoded_list)
+        if self.string_format == 'native':
+            self.decode_bytes_slots()
+        self.walk(0)
+        return self.raws[0]
+
+    # string_format 'native': decode the bytes slots listed in the last slot
+    # (which is not walked itself)
+    def decode_bytes_slots(self):
+        for idx in self.encoded[-1]:
+            s = self.encoded[idx]
+            self.raws[idx] = s if isinstance(s, bytes) else s.encode('latin1')
+            self.done[idx] = 1
+        self.done[len(self.encoded) - 1] = 1
+
+    def get_buffer(self, buffer_idx):
+        if not 0 <= buffer_idx < len(self.buffers):
+            raise Exception('Out-of-band buffer %d was not supplied' % buffer_idx)
+        return self.buffers[buffer_idx]
 
     # Mark object into ids dictionary
     def seen_decode(self, obj):
@@ -271,74 +773,223 @@ class PostDecoder():
         self.ids[idd] = obj
 
     def calculate_deserializer(self, encoded):
-        decoder_init_fn = None
-        decoder_final_fn = None
-        deserial_obj = None
-        if len(encoded) > 1 and isinstance(encoded[0], str_types):
-            strn = force_str_type0(encoded[0])
-            if strn == 'py/':
-                return dict, None, None
-            check_pytype = deserializer_match(strn)
-            if not check_pytype is None:
-                deserial_name = check_pytype.groups()[0]
-                deserial_name = force_str_type0(deserial_name)
-                if not deserial_name in self.decoders:
-                    raise Exception("Don't know how to decode py/%s" % deserial_name)
-                decoder_init_fn, decoder_final_fn = self.decoders[deserial_name]
-        return decoder_init_fn, decoder_final_fn, deserial_obj
-
-    def walk(self, slot):
-        if not slot.done:
-            slot.done = True
-            if not isinstance(slot.encoded, list):
-                if not isinstance(slot.encoded, str_types):
-                    # basic type
-                    slot.raw = slot.encoded
-                else:
-                    slot.raw = decode_str(slot.encoded)
-                return
+        # A str first element is always a tag: strings inside lists are
+        # stored in their own slots. This includes empty dicts (['py/']).
+        if len(encoded) > 0 and isinstance(encoded[0], str_types):
+            deserializer = self.tags.get(encoded[0])
+            if deserializer is not None:
+                return deserializer
+            deserial_name = deserializer_name(encoded[0])
+            if not deserial_name is None:
+                raise Exception("Don't know how to decode py/%s" % deserial_name)
+        return plain_list_deserializer
+
+    # Start decoding slot idx, which was just reached for the first time.
+    # Strings and basic types are finished immediately (returns False).
+    # Containers and custom objects push a frame onto the work stack (returns
+    # True). Frames are [kind, idx, position, resuming] for lists and dicts,
+    # and [kind, idx, phase, init_fn, final_fn] for custom decoders.
+    def enter(self, idx, stack):
+        self.done[idx] = 1
+        encoded = self.encoded[idx]
+        if not isinstance(encoded, list):
+            if not isinstance(encoded, str_types):
+                # basic type
+                self.raws[idx] = encoded
             else:
-                (decoder_init_fn, decoder_final_fn, deserial_obj
-                    ) = self.calculate_deserializer(slot.encoded)
-            if not decoder_init_fn:
-                # Plain list
-                slot.raw = [None] * len(slot.encoded)
-                for k, item in enumerate(slot.encoded):
+                self.raws[idx] = self.decode_str(encoded)
+            return False
+        deserializer = self.deserializers[idx]
+        if deserializer is None:
+            deserializer = self.calculate_deserializer(encoded)
+            self.deserializers[idx] = deserializer
+        decoder_init_fn, decoder_final_fn, deserial_obj = deserializer
+        if not decoder_init_fn:
+            # Plain list
+            self.raws[idx] = [None] * len(encoded)
+            stack.append([FRAME_LIST, idx, 0, False])
+        elif decoder_init_fn == dict:
+            # Dictionary
+            self.raws[idx] = {}
+            stack.append([FRAME_DICT, idx, 1, False])
+        elif decoder_init_fn == COMPACT_DICT:
+            # Dictionary, compact layout
+            self.raws[idx] = {}
+            stack.append([FRAME_COMPACT_DICT, idx, 1, 0, None])
+        elif decoder_init_fn == PACKED_LIST:
+            # Created once its buffer slot is decoded
+            stack.append([FRAME_PACKED_LIST, idx])
+        elif decoder_init_fn == TEMPLATE_DICT:
+            # Dictionary, filled from the shape's keys once all values are in
+            self.raws[idx] = {}
+            stack.append(
+                [FRAME_TEMPLATE_DICT, idx, 1, False, [None] * (len(encoded) - 1)])
+        else:
+            # Custom decoder
+            if not len(encoded) in (2, 3):
+                raise Exception('Unexpected error on slot %d' % idx)
+            stack.append(
+                [FRAME_CUSTOM, idx, 0, decoder_init_fn, decoder_final_fn])
+        return True
+
+    # Make sure slot idx gets decoded. Returns True when a frame was pushed,
+    # i.e. the caller has to wait for it before using the slot's raw object.
+    def descend(self, idx, stack):
+        return not self.done[idx] and self.enter(idx, stack)
+
+    # Iterative counterpart of PreEncoder.walk: objects are created in the
+    # same order a recursive walk would create them, so circular references
+    # resolve to the same (possibly still incomplete) objects.
+    # A FRAME_COMPACT_DICT frame is [kind, idx, key position, pending, key]
+    # where pending is 1 while waiting for the key's slot and 2 while
+    # waiting for the value's slot (key then holds the decoded key).
+    def walk(self, idx):
+        if self.done[idx]:
+            return
+        slots_encoded = self.encoded
+        raws = self.raws
+        done = self.done
+        stack = []
+        self.enter(idx, stack)
+        while stack:
+            frame = stack[-1]
+            kind = frame[0]
+            idx = frame[1]
+            encoded = slots_encoded[idx]
+            if kind == FRAME_LIST:
+                raw = raws[idx]
+                k = frame[2]
+                if frame[3]:
+                    raw[k] = raws[encoded[k][0]]
+                    k += 1
+                n = len(encoded)
+                while k < n:
+                    item = encoded[k]
                     if not isinstance(item, list):
                         # Has to be a basic type
-                        slot.raw[k] = item
+                        raw[k] = item
                     else:
-                        idx = item[0]
-                        self.walk(self.slots[idx])
-                        slot.raw[k] = self.slots[idx].raw
-            elif decoder_init_fn == dict:
-                # Dictionary
-                slot.raw = {}
-                for kv_idx in slot.encoded[1:]:
-                    self.walk(self.slots[kv_idx])
-                    key, value = self.slots[kv_idx].raw
-                    slot.raw[key] = value
-            else:
-                # Custom decoder
-                if not len(slot.encoded) in (2, 3):
-                    raise Exception('Unexpected error on slot %d' % slot.idx)
-                init_idx = slot.encoded[1]
-                self.walk(self.slots[init_idx])
-                init_slot = self.slots[init_idx]
-                init_params = init_slot.raw
-                slot.raw = decoder_init_fn(init_params)
-                if slot.raw is None:
-                    raise Exception('Cannot provide init decoder that returns None')
-                if len(slot.encoded) == 3:
-                    final_idx = slot.encoded[2]
-                    self.walk(self.slots[final_idx])
-                    final_slot = self.slots[final_idx]
-                    final_params = final_slot.raw
-                    raw2 = decoder_final_fn(slot.raw, final_params)
-                    if slot.raw is None:
-                        slot.raw = raw2
-                    elif not slot.raw is raw2:
-                        raise Exception('Object finalizer function must return the same object')
+                        sub_idx = item[0]
+                        if not done[sub_idx] and self.enter(sub_idx, stack):
+                            frame[2] = k
+                            frame[3] = True
+                            break
+                        raw[k] = raws[sub_idx]
+                    k += 1
+                else:
+                    stack.pop()
+            elif kind == FRAME_DICT:
+                raw = raws[idx]
+                k = frame[2]
+                if frame[3]:
+                    key, value = raws[encoded[k]]
+                    raw[key] = value
+                    k += 1
+                n = len(encoded)
+                while k < n:
+                    sub_idx = encoded[k]
+                    if not done[sub_idx] and self.enter(sub_idx, stack):
+                        frame[2] = k
+                        frame[3] = True
+                        break
+                    key, value = raws[sub_idx]
+                    raw[key] = value
+                    k += 1
+                else:
+                    stack.pop()
+            elif kind == FRAME_COMPACT_DICT:
+                raw = raws[idx]
+                k = frame[2]
+                pending = frame[3]
+                n = len(encoded)
+                while k < n:
+                    if pending == 2:
+                        key = frame[4]
+                    else:
+                        item = encoded[k]
+                        if pending == 1:
+                            key = raws[item[0]]
+                        elif not isinstance(item, list):
+                            key = item
+                        else:
+                            sub_idx = item[0]
+                            if not done[sub_idx] and self.enter(sub_idx, stack):
+                                frame[2] = k
+                                frame[3] = 1
+                                break
+                            key = raws[sub_idx]
+                    item = encoded[k + 1]
+                    if pending == 2:
+                        value = raws[item[0]]
+                    elif not isinstance(item, list):
+                        value = item
+                    else:
+                        sub_idx = item[0]
+                        if not done[sub_idx] and self.enter(sub_idx, stack):
+                            frame[2] = k
+                            frame[3] = 2
+                            frame[4] = key
+                            break
+                        value = raws[sub_idx]
+                    raw[key] = value
+                    pending = 0
+                    k += 2
+                else:
+                    stack.pop()
+            elif kind == FRAME_TEMPLATE_DICT:
+                # Like FRAME_LIST, collecting the shape and values in frame[4]
+                items = frame[4]
+                k = frame[2]
+                if frame[3]:
+                    items[k - 1] = raws[encoded[k][0]]
+                    k += 1
+                n = len(encoded)
+                while k < n:
+                    item = encoded[k]
+                    if not isinstance(item, list):
+                        items[k - 1] = item
+                    else:
+                        sub_idx = item[0]
+                        if not done[sub_idx] and self.enter(sub_idx, stack):
+                            frame[2] = k
+                            frame[3] = True
+                            break
+                        items[k - 1] = raws[sub_idx]
+                    k += 1
+                else:
+                    raws[idx].update(zip(items[0], items[1:]))
+                    stack.pop()
+            elif kind == FRAME_PACKED_LIST:
+                buffer_idx = encoded[2][0]
+                if self.descend(buffer_idx, stack):
+                    continue
+                raws[idx] = unpack_list(encoded[1], raws[buffer_idx])
+                stack.pop()
+            else:  # FRAME_CUSTOM
+                phase = frame[2]
+                if phase == 0:
+                    frame[2] = phase = 1
+                    if self.descend(encoded[1], stack):
+                        continue
+                if phase == 1:
+                    init_params = raws[encoded[1]]
+                    raw = frame[3](init_params)
+                    if raw is None:
+                        raise Exception('Cannot provide init decoder that returns None')
+                    raws[idx] = raw
+                    if len(encoded) != 3:
+                        stack.pop()
+                        continue
+                    frame[2] = 2
+                    if self.descend(encoded[2], stack):
+                        continue
+                final_params = raws[encoded[2]]
+                raw2 = frame[4](raws[idx], final_params)
+                if raws[idx] is None:
+                    raws[idx] = raw2
+                elif not raws[idx] is raw2:
+                    raise Exception('Object finalizer function must return the same object')
+                stack.pop()
 
 
 def encode_tuple(obj):
@@ -349,61 +1000,404 @@ def decode_tuple(config):
     return tuple(config)
 
 
-def encode_np_ndarray(obj):
+def encode_set(obj):
+    return list(obj), None
+
+
+def decode_set(config):
+    return set(config)
+
+
+def decode_frozenset(config):
+    return frozenset(config)
+
+
+# [year, month, day, hour, minute, second, microsecond], followed by the UTC
+# offset in seconds for aware datetimes. Only the offset of the tzinfo is
+# kept: aware datetimes decode with a fixed-offset timezone (python 3 only).
+def encode_datetime(obj):
+    config = [obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second,
+        obj.microsecond]
+    offset = obj.utcoffset()
+    if offset is not None:
+        config.append(offset.total_seconds())
+    return config, None
+
+
+def decode_datetime(config):
+    import datetime
+    tzinfo = None
+    if len(config) > 7:
+        if not hasattr(datetime, 'timezone'):
+            raise Exception('Aware datetimes need python 3')
+        tzinfo = datetime.timezone(datetime.timedelta(seconds = config[7]))
+    return datetime.datetime(*config[:7], tzinfo = tzinfo)
+
+
+# Compression of ndarray data and bytes blobs.
+# compression_codecs is name:(compress_fn(data, level), decompress_fn(data));
+# level None means the codec's default. The codec modules are imported when
+# first used; bz2 and lzma are left out when python was built without them.
+compression_codecs = {
+    'zlib': (lambda data, level: zlib.compress(data, 6 if level is None else level),
+        lambda data: zlib.decompress(data)),
+}
+if module_available('bz2'):
+    compression_codecs['bz2'] = (
+        lambda data, level: bz2.compress(data, 9 if level is None else level),
+        lambda data: bz2.decompress(data))
+if module_available('lzma'):
+    compression_codecs['lzma'] = (
+        lambda data, level: lzma.compress(data, preset = level),
+        lambda data: lzma.decompress(data))
+
+# Data smaller than compression_min_size is stored as is. Larger data is
+# split into chunks of compression_chunk_size bytes, which are (de)compressed
+# in compression_pool; the codecs release the GIL, so that uses all cores.
+compression_min_size = 1 << 16
+compression_chunk_size = 1 << 22
+# The pool's threads do not survive a fork, so a child process (e.g. a
+# parallel.encode worker) starts a pool of its own.
+compression_pool = None
+compression_pool_pid = None
+
+
+def get_compression_pool():
+    global compression_pool, compression_pool_pid
+    if compression_pool is None or compression_pool_pid != os.getpid():
+        from concurrent.futures import ThreadPoolExecutor
+        compression_pool = ThreadPoolExecutor()
+        compression_pool_pid = os.getpid()
+    return compression_pool
+
+
+def map_chunks(fn, chunks):
+    if len(chunks) < 2:
+        return [fn(chunk) for chunk in chunks]
+    try:
+        pool = get_compression_pool()
+    except ImportError:  # python2 without the futures backport
+        return [fn(chunk) for chunk in chunks]
+    return list(pool.map(fn, chunks))
+
+
+# Compresses buffer buf (a memoryview) chunk by chunk. Returns
+# ([codec, chunk sizes], compressed chunks), or None when compression does not
+# make the data smaller.
+def compress_buffer(buf, codec, level = None,
+        chunk_size = compression_chunk_size):
+    if not codec in compression_codecs:
+        raise Exception('Unknown compression codec %r' % (codec,))
+    compress_fn = compression_codecs[codec][0]
+    if buf.ndim != 1 or buf.itemsize != 1:
+        buf = buf.cast('B')
+    pieces = [buf[k:k + chunk_size] for k in range(0, len(buf), chunk_size)]
+    chunks = map_chunks(lambda piece: compress_fn(piece, level), pieces)
+    if sum(len(chunk) for chunk in chunks) >= len(buf):
+        return None
+    return ([codec, [len(piece) for piece in pieces]],
+        [memoryview(chunk) for chunk in chunks])
+
+
+# Inverse of compress_buffer, returns a bytearray
+def decompress_buffer(compression, chunks):
+    codec, sizes = compression
+    codec = force_str_type0(codec)
+    if not codec in compression_codecs:
+        raise Exception('Unknown compression codec %r' % (codec,))
+    decompress_fn = compression_codecs[codec][1]
+    if len(sizes) != len(chunks):
+        raise Exception('Compression chunk table does not match the data')
+    offsets = [0]
+    for size in sizes:
+        offsets.append(offsets[-1] + size)
+    out = bytearray(offsets[-1])
+    view = memoryview(out)
+    def decompress_chunk(k):
+        data = decompress_fn(chunks[k])
+        if len(data) != sizes[k]:
+            raise Exception('Compressed chunk %d has the wrong size' % k)
+        view[offsets[k]:offsets[k + 1]] = data
+    map_chunks(decompress_chunk, range(len(chunks)))
+    return out
+
+
+# dtype as it is encoded: its name when that alone gives back the dtype (the
+# common case, e.g. 'float64' or 'object'), else dtype.str ('>i4', '<U8') or,
+# for structured dtypes, the descr as nested lists.
+def encode_np_dtype(dtype):
+    if dtype.fields is None:
+        try:
+            if np.dtype(dtype.name) == dtype:
+                return dtype.name
+        except TypeError:
+            pass
+        return dtype.str
+    if hasattr(np.lib.format, 'dtype_to_descr'):
+        descr = np.lib.format.dtype_to_descr(dtype)
+    else:
+        descr = dtype.descr
+    return descr_to_lists(descr)
+
+
+def descr_to_lists(descr):
+    if not isinstance(descr, list):
+        return descr
+    return [[descr_to_lists(item) for item in field] for field in descr]
+
+
+def decode_np_dtype(spec):
+    if not isinstance(spec, list):
+        return np.dtype(force_str_type0(spec))
+    descr = lists_to_descr(spec)
+    if hasattr(np.lib.format, 'descr_to_dtype'):
+        return np.lib.format.descr_to_dtype(descr)
+    return np.dtype(descr)
+
+
+# Back from descr_to_lists: fields, (title, name) pairs and shapes are tuples
+def lists_to_descr(spec):
+    descr = []
+    for field in spec:
+        name, fmt = field[:2]
+        if isinstance(name, list):
+            name = tuple(force_str_type0(s) for s in name)
+        else:
+            name = force_str_type0(name)
+        if isinstance(fmt, list):
+            fmt = lists_to_descr(fmt)
+        else:
+            fmt = force_str_type0(fmt)
+        if len(field) > 2:
+            descr.append((name, fmt, tuple(field[2])))
+        else:
+            descr.append((name, fmt))
+    return descr
+
+
+# Compression settings of encode_np_ndarray: data of at least min_size bytes
+# whose dtype.kind is in dtype_kinds is compressed with codec (a
+# compression_codecs name, None to never compress).
+#
+# The dtype is encoded in full (see encode_np_dtype), including byte order
+# and fields of structured dtypes. C and Fortran contiguous arrays hand out
+# their memory as is, Fortran order being recorded as ['order', 'F']; other
+# arrays are copied into C order. Object arrays have no data buffer: their
+# elements are encoded as a flat list (in C order) after the shape, so they
+# can refer to the array itself.
+def encode_np_ndarray(obj, compression = None, level = None,
+        min_size = compression_min_size, dtype_kinds = 'biufc',
+        chunk_size = compression_chunk_size):
+    dtype = encode_np_dtype(obj.dtype)
     if not isinstance('', bytes):
         data_key = 'data'
+        compression_key = 'compression'
+        order_key = 'order'
         obj_init = [
-            ['dtype', obj.dtype.name], 
+            ['dtype', dtype], 
             ['shape', obj.shape], 
         ]
     else:
         data_key = b'data'
+        compression_key = b'compression'
+        order_key = b'order'
         obj_init = [
-            [b'dtype', obj.dtype.name.encode()],
+            [b'dtype', dtype.encode() if isinstance(dtype, str) else dtype],
             [b'shape', obj.shape], 
         ]
     obj_final = None
-    if obj.dtype.name == 'object':
-        obj_init.append([data_key, obj[()]])
-        obj_final = obj_init[1:]
-        obj_init = obj_init[:1]
+    if obj.dtype.hasobject:
+        if obj.dtype.kind != 'O':
+            raise Exception('Structured dtypes with object fields are not '
+                'supported: %s' % (obj.dtype,))
+        if obj.ndim == 0:
+            obj_init.append([data_key, obj[()]])
+            obj_final = obj_init[1:]
+            obj_init = obj_init[:1]
+        else:
+            obj_final = [[data_key, obj.ravel().tolist()]]
     else:
-        obj_init.append([data_key, obj.tobytes()])
+        # Hand out the array memory itself. PreEncoder either copies it
+        # in-band or passes it to its buffer_callback without copying.
+        # Non-contiguous arrays have no single buffer, so they are copied
+        # into C order first.
+        if obj.flags.c_contiguous:
+            flat = obj.reshape(-1)
+        elif obj.flags.f_contiguous:
+            flat = obj.T.reshape(-1)
+            obj_init.append([order_key, 'F'])
+        else:
+            flat = np.ascontiguousarray(obj).reshape(-1)
+        data = memoryview(flat.view(np.uint8))
+        if (compression is not None and obj.nbytes >= min_size
+                and obj.dtype.kind in dtype_kinds):
+            compressed = compress_buffer(data, compression, level, chunk_size)
+            if compressed is not None:
+                obj_init.append([compression_key, compressed[0]])
+                data = compressed[1]
+        obj_init.append([data_key, data])
     return obj_init, obj_final
 
 
+# Encoder function for the encoders dictionary that compresses array data,
+# see encode_np_ndarray
+def np_ndarray_encoder(compression = 'zlib', level = None,
+        min_size = compression_min_size, dtype_kinds = 'biufc',
+        chunk_size = compression_chunk_size):
+    if not compression in compression_codecs:
+        raise Exception('Unknown compression codec %r' % (compression,))
+    def encoder(obj):
+        return encode_np_ndarray(obj, compression, level, min_size,
+            dtype_kinds, chunk_size)
+    return encoder
+
+
 def decode_np_ndarray_init(config):
     config = dict(config)
     force_str_type0_keys(config)
+    dtype = decode_np_dtype(config['dtype'])
 
-    if not config['dtype'] == 'object':
-        obj = np.fromstring(config['data'], dtype = config['dtype'])
-        obj = obj.reshape(config['shape'])
+    if not dtype.hasobject:
+        data = config['data']
+        if config.get('compression') is not None:
+            data = decompress_buffer(config['compression'], data)
+        obj = np.frombuffer(data, dtype = dtype)
+        if isinstance(data, bytes):
+            # In-band data: copy so the array is writable, as it used to be.
+            # Out-of-band buffers are used as is (no copy).
+            obj = obj.copy()
+        order = force_str_type0(config.get('order', 'C'))
+        obj = obj.reshape(config['shape'], order = order)
     else:
-        obj = np.array(None, dtype = 'object')
+        # 0-d object arrays have their shape in the final params
+        obj = np.empty(config.get('shape', ()), dtype = 'object')
     return obj
 
 
 def decode_np_ndarray_final(obj, config):
-    if not config is None:  # only when it was an the special np.object
+    if not config is None:  # only for object arrays
         config = dict(config)
-        obj[()] = config['data']
+        force_str_type0_keys(config)
+        if 'shape' in config:
+            obj[()] = config['data']
+        else:
+            # Element by element, so list elements are not broadcast
+            flat = obj.reshape(-1)
+            for k, item in enumerate(config['data']):
+                flat[k] = item
     return obj
 
 
-def encode_bytes(obj):
-    enc0 = obj.decode('latin1'); enc1 = b64encode(obj).decode('latin1')
-    if len(json.dumps(enc0)) < len(json.dumps(enc1)):
-        return [0, enc0], None
-    else:
-        return [1, enc1], None
+# JSON length (without quotes) of each byte once it is mapped to a latin1
+# character: printable ASCII is 1, \" \\ \b \t \n \f \r are 2, and every
+# other byte becomes \u00XX (json.dumps escapes all non-ASCII by default).
+bytes_json_cost = bytearray(6 for _ in range(256))
+for _k in range(0x20, 0x7f):
+    bytes_json_cost[_k] = 1
+for _c in b'"\\\b\t\n\f\r':
+    bytes_json_cost[ord(_c) if isinstance(_c, str) else _c] = 2
+bytes_json_cost = bytes(bytes_json_cost)
+del _k, _c
+
+# Blobs larger than bytes_sample_threshold are not counted fully; instead
+# bytes_sample_chunks evenly spread chunks totalling bytes_sample_size bytes
+# are counted and the result is scaled up.
+bytes_sample_threshold = 1 << 20
+bytes_sample_size = 1 << 16
+bytes_sample_chunks = 16
+
+
+# Length of json.dumps(obj.decode('latin1')) minus the quotes
+def bytes_escape_cost(obj):
+    costs = obj.translate(bytes_json_cost)
+    return len(obj) + costs.count(b'\x02') + 5 * costs.count(b'\x06')
+
+
+def bytes_sample(obj, sample_size, chunks = bytes_sample_chunks):
+    chunk = max(sample_size // chunks, 1)
+    step = (len(obj) - chunk) // max(chunks - 1, 1)
+    return b''.join(obj[k * step:k * step + chunk] for k in range(chunks))
+
+
+# Bytes encoding strategies:
+# - 'estimate': latin1 text or base64, whichever is shorter as JSON. The
+#   escape cost of the latin1 text is counted per byte class (on a sample
+#   for blobs above sample_threshold) instead of building both strings.
+# - 'exact': the same choice, made by json.dumps'ing both candidates
+# - 'latin1', 'base64', 'base85': always use that encoding
+# - 'buffer': hand the blob out as a buffer, like ndarray data: raw with the
+#   binary backend, a buffer_callback or in a container file, a plain string
+#   otherwise
+# Encoded as [0, latin1 text], [1, base64 text], [2, base85 text] or
+# [4, buffer].
+# Blobs of at least min_size bytes are compressed with codec compression
+# instead (see encode_np_ndarray) when that makes them smaller, encoded as
+# [3, [codec, chunk sizes], compressed chunks].
+bytes_strategies = ('estimate', 'exact', 'latin1', 'base64', 'base85',
+    'buffer')
+
+
+def encode_bytes(obj, strategy = 'estimate',
+        sample_threshold = bytes_sample_threshold,
+        sample_size = bytes_sample_size, compression = None, level = None,
+        min_size = compression_min_size, chunk_size = compression_chunk_size):
+    if compression is not None and len(obj) >= min_size:
+        compressed = compress_buffer(
+            memoryview(obj), compression, level, chunk_size)
+        if compressed is not None:
+            return [3, compressed[0], compressed[1]], None
+    if strategy == 'estimate':
+        if len(obj) > sample_threshold:
+            sample = bytes_sample(obj, sample_size)
+            cost = bytes_escape_cost(sample) * len(obj) // len(sample)
+        else:
+            cost = bytes_escape_cost(obj)
+        strategy = 'latin1' if cost < 4 * ((len(obj) + 2) // 3) else 'base64'
+    elif strategy == 'exact':
+        enc0 = obj.decode('latin1'); enc1 = base64.b64encode(obj).decode('latin1')
+        if len(json.dumps(enc0)) < len(json.dumps(enc1)):
+            return [0, enc0], None
+        else:
+            return [1, enc1], None
+    if strategy == 'latin1':
+        return [0, obj.decode('latin1')], None
+    elif strategy == 'base64':
+        return [1, base64.b64encode(obj).decode('latin1')], None
+    elif strategy == 'base85':
+        return [2, b85_functions()[0](obj).decode('latin1')], None
+    elif strategy == 'buffer':
+        return [4, memoryview(obj)], None
+    raise Exception('Unknown bytes strategy %r' % (strategy,))
+
+
+# Encoder function for the encoders dictionary using a non-default strategy
+def bytes_encoder(strategy = 'estimate',
+        sample_threshold = bytes_sample_threshold,
+        sample_size = bytes_sample_size, compression = None, level = None,
+        min_size = compression_min_size, chunk_size = compression_chunk_size):
+    if not strategy in bytes_strategies:
+        raise Exception('Unknown bytes strategy %r' % (strategy,))
+    if compression is not None and not compression in compression_codecs:
+        raise Exception('Unknown compression codec %r' % (compression,))
+    def encoder(obj):
+        return encode_bytes(obj, strategy, sample_threshold, sample_size,
+            compression, level, min_size, chunk_size)
+    return encoder
 
 
 def decode_bytes(obj):
     if obj[0] == 0:
         return obj[1].encode('latin1')
     elif obj[0] == 1:
-        return b64decode(obj[1])
+        return base64.b64decode(obj[1])
+    elif obj[0] == 2:
+        return b85_functions()[1](obj[1])
+    elif obj[0] == 3:
+        return bytes(decompress_buffer(obj[1], obj[2]))
+    elif obj[0] == 4:
+        if isinstance(obj[1], bytes):
+            return obj[1]
+        return memoryview(obj[1]).tobytes()
     else:
         raise NeverHappens
 
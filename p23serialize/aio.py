@@ -0,0 +1,109 @@
+import asyncio
+import json
+import struct
+
+from .stream import StreamDecoder
+
+'''
+Asyncio decoding of the record streams written by stream.StreamEncoder
+(python 3 only, not imported by the package itself).
+
+AsyncStreamDecoder reads records from an asyncio.StreamReader as the bytes
+arrive and yields every completed message (root object). Records of at least
+offload_min bytes are parsed and applied in an executor (the default one of
+the loop unless given), so building large ndarrays/bytes does not block the
+event loop. Records are still applied one after the other, in stream order.
+Smaller records are applied in the loop, which gets a turn (sleep(0)) after
+every yield_bytes bytes of them: a message of many small records that have
+all arrived already would otherwise keep it blocked.
+'''
+
+read_size = 1 << 16
+get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncStreamDecoder(StreamDecoder):
+
+    def __init__(self, decoders = {}, buffers = None, executor = None,
+            offload_min = 1 << 20, yield_bytes = 1 << 16):
+        StreamDecoder.__init__(self, decoders, buffers)
+        self.executor = executor
+        self.offload_min = offload_min
+        self.yield_bytes = yield_bytes
+        self.unyielded = 0  # bytes applied in the loop since its last turn
+        self.pending = bytearray()  # jsonl bytes read past the last record
+
+    # Returns the next record's payload from reader, None at the end of the
+    # stream.
+    async def read_payload(self, reader, fmt = 'jsonl'):
+        if fmt == 'jsonl':
+            # Not reader.readline: it fails for lines beyond the reader's limit
+            pending = self.pending
+            start = 0  # pending[:start] has no newline
+            while True:
+                k = pending.find(b'\n', start)
+                if k < 0:
+                    start = len(pending)
+                    chunk = await reader.read(read_size)
+                    if chunk:
+                        pending += chunk
+                        continue
+                    line = bytes(pending)
+                    del pending[:]
+                    return line if line.strip() else None
+                line = bytes(pending[:k])
+                del pending[:k + 1]
+                start = 0
+                if line.strip():
+                    return line
+        elif fmt == 'prefixed':
+            try:
+                header = await reader.readexactly(4)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    raise Exception('Truncated record header')
+                return None
+            n = struct.unpack('>I', header)[0]
+            try:
+                return await reader.readexactly(n)
+            except asyncio.IncompleteReadError:
+                raise Exception('Truncated record')
+        raise Exception('Unknown stream format %r' % (fmt,))
+
+    # Parse and apply one record, see StreamDecoder.feed
+    def feed_payload(self, payload):
+        return self.feed(json.loads(payload.decode('utf8')))
+
+    # Returns (True, obj) for the next message from reader, (False, None) at
+    # the end of the stream.
+    async def read_message(self, reader, fmt = 'jsonl'):
+        while True:
+            payload = await self.read_payload(reader, fmt)
+            if payload is None:
+                return False, None
+            if len(payload) >= self.offload_min:
+                done, obj = await get_loop().run_in_executor(
+                    self.executor, self.feed_payload, payload)
+            else:
+                done, obj = self.feed_payload(payload)
+                self.unyielded += len(payload)
+                if self.unyielded >= self.yield_bytes:
+                    self.unyielded = 0
+                    await asyncio.sleep(0)
+            if done:
+                return True, obj
+
+    # Decode the messages from reader one after the other.
+    async def iter_decode(self, reader, fmt = 'jsonl'):
+        while True:
+            done, obj = await self.read_message(reader, fmt)
+            if not done:
+                return
+            yield obj
+
+    # Decode the next message from reader.
+    async def decode(self, reader, fmt = 'jsonl'):
+        done, obj = await self.read_message(reader, fmt)
+        if not done:
+            raise Exception('End of stream before a complete message')
+        return obj
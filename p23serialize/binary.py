@@ -0,0 +1,349 @@
+from __future__ import print_function
+
+import struct
+from codecs import utf_8_decode
+
+from . import PreEncoder, PostDecoder, str_mode
+from .util import unicode_type
+
+'''
+Binary wire format.
+
+The slot table is written as a msgpack array with one element per slot.
+Strings and bytes use msgpack's native str and bin types, so nothing is
+prefixed or text-escaped. The slot table constructs that JSON has to spell
+with plain lists get msgpack extension types instead:
+
+- EXT_REF (1): reference to a slot from a list (JSON: [idx]),
+  data is the slot index as a big-endian unsigned int
+- EXT_TAG (2): 'py/<name>' tag of dicts and custom objects (tuple, ndarray,
+  ...), data is <name> in utf8
+- EXT_BUFFER (3): raw buffer data, e.g. ndarray memory. It is written
+  straight from the array and loads returns it as a memoryview onto the
+  input, so ndarrays are rebuilt without copying.
+- EXT_BIGINT (4): integer outside the 64 bit range, data is big-endian
+  two's complement
+
+dumps/loads are the entry points; the encoders/decoders arguments and the
+encoder options are the same as for PreEncoder/PostDecoder.
+'''
+
+EXT_REF = 1
+EXT_TAG = 2
+EXT_BUFFER = 3
+EXT_BIGINT = 4
+
+# Buffers at least this large are passed to the output as separate pieces
+# instead of being copied into the current chunk.
+big_buffer = 1 << 16
+
+if str_mode == 'bytes':
+    int_types = (int, long)
+    byte_value = ord
+else:  # str_mode == 'unicode'
+    int_types = (int,)
+    byte_value = int
+
+pack_H = struct.Struct('>H').pack
+pack_I = struct.Struct('>I').pack
+pack_Q = struct.Struct('>Q').pack
+pack_q = struct.Struct('>q').pack
+pack_d = struct.Struct('>d').pack
+unpack_H = struct.Struct('>H').unpack_from
+unpack_I = struct.Struct('>I').unpack_from
+unpack_Q = struct.Struct('>Q').unpack_from
+unpack_b = struct.Struct('>b').unpack_from
+unpack_h = struct.Struct('>h').unpack_from
+unpack_i = struct.Struct('>i').unpack_from
+unpack_q = struct.Struct('>q').unpack_from
+unpack_d = struct.Struct('>d').unpack_from
+
+
+def native(s):
+    return s
+
+
+class BinaryPreEncoder(PreEncoder):
+
+    # Keeps strings and in-band buffers as they are, instead of turning them
+    # into prefixed text. options are passed on to PreEncoder.
+    def __init__(self, encoders = {}, **options):
+        PreEncoder.__init__(self, encoders, **options)
+        self.encode_str = native
+        self.encode_buffer = native
+        self.bytes_slots = None  # strings are native already
+
+
+class BinaryPostDecoder(PostDecoder):
+
+    def __init__(self, decoders = {}):
+        PostDecoder.__init__(self, decoders)
+        self.decode_str = native
+
+
+def pack_header(out, n, fix_tag, fix_max, tag8, tag16, tag32):
+    if n < fix_max:
+        out.append(fix_tag | n)
+    elif tag8 is not None and n < 0x100:
+        out.append(tag8)
+        out.append(n)
+    elif n < 0x10000:
+        out.append(tag16)
+        out += pack_H(n)
+    else:
+        out.append(tag32)
+        out += pack_I(n)
+
+
+def pack_ext_header(out, ext_type, n):
+    if n in (1, 2, 4, 8, 16):
+        out.append({1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8}[n])
+    elif n < 0x100:
+        out.append(0xc7)
+        out.append(n)
+    elif n < 0x10000:
+        out.append(0xc8)
+        out += pack_H(n)
+    else:
+        out.append(0xc9)
+        out += pack_I(n)
+    out.append(ext_type)
+
+
+def pack_int(out, v):
+    if 0 <= v < 0x80:
+        out.append(v)
+    elif -0x20 <= v < 0:
+        out.append(v & 0xff)
+    elif -0x8000000000000000 <= v < 0x8000000000000000:
+        out.append(0xd3)
+        out += pack_q(v)
+    elif 0 < v < 0x10000000000000000:
+        out.append(0xcf)
+        out += pack_Q(v)
+    else:
+        n = (v.bit_length() + 8) // 8  # room for the sign bit
+        data = bytearray(n)
+        w = v
+        for k in range(n - 1, -1, -1):
+            data[k] = w & 0xff
+            w >>= 8
+        pack_ext_header(out, EXT_BIGINT, n)
+        out += data
+
+
+# Appends v to out. Returns a big buffer that the caller has to emit as a
+# separate piece right after out, or None.
+def pack_value(out, v):
+    t = type(v)
+    if v is None:
+        out.append(0xc0)
+    elif t is bool:
+        out.append(0xc3 if v else 0xc2)
+    elif t in int_types:
+        pack_int(out, v)
+    elif t is float:
+        out.append(0xcb)
+        out += pack_d(v)
+    elif t is unicode_type:
+        data = v.encode('utf8')
+        pack_header(out, len(data), 0xa0, 32, 0xd9, 0xda, 0xdb)
+        out += data
+    elif t is bytes:
+        pack_header(out, len(v), 0, 0, 0xc4, 0xc5, 0xc6)
+        out += v
+    elif t is memoryview:
+        data = v.cast('B') if v.ndim != 1 or v.format != 'B' else v
+        pack_ext_header(out, EXT_BUFFER, data.nbytes)
+        if data.nbytes >= big_buffer:
+            return data
+        out += data
+    elif isinstance(v, bool):
+        out.append(0xc3 if v else 0xc2)
+    elif isinstance(v, int_types):
+        pack_int(out, int(v))
+    elif isinstance(v, float):
+        out.append(0xcb)
+        out += pack_d(v)
+    else:
+        raise Exception('Cannot pack %r' % (type(v),))
+    return None
+
+
+# Yields the msgpack encoding of a slot table as a sequence of bytes-like
+# pieces.
+def pack_slots(slots):
+    out = bytearray()
+    pack_header(out, len(slots), 0x90, 16, None, 0xdc, 0xdd)
+    for slot in slots:
+        if type(slot) is not list:
+            big = pack_value(out, slot)
+            if big is not None:
+                yield out
+                yield big
+                out = bytearray()
+            continue
+        pack_header(out, len(slot), 0x90, 16, None, 0xdc, 0xdd)
+        for k, item in enumerate(slot):
+            if type(item) is list:
+                idx = item[0]
+                if idx < 0x100000000:
+                    out += b'\xd6\x01'  # fixext4, EXT_REF
+                    out += pack_I(idx)
+                else:
+                    out += b'\xd7\x01'  # fixext8, EXT_REF
+                    out += pack_Q(idx)
+            elif k == 0 and isinstance(item, (bytes, unicode_type)):
+                # Strings only show up in lists as tags
+                if isinstance(item, unicode_type):
+                    item = item.encode('utf8')
+                name = item[3:]
+                pack_ext_header(out, EXT_TAG, len(name))
+                out += name
+            else:
+                pack_value(out, item)
+        if len(out) >= big_buffer:
+            yield out
+            out = bytearray()
+    yield out
+
+
+# Returns (value, new_pos) for the item at pos
+def unpack_value(buf, pos):
+    code = byte_value(buf[pos])
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    elif code >= 0xe0:
+        return code - 0x100, pos
+    elif 0xa0 <= code < 0xc0:
+        n = code & 0x1f
+        return utf_8_decode(buf[pos:pos + n], None, True)[0], pos + n
+    elif 0x90 <= code < 0xa0:
+        return unpack_array(buf, pos, code & 0x0f)
+    elif code == 0xc0:
+        return None, pos
+    elif code == 0xc2:
+        return False, pos
+    elif code == 0xc3:
+        return True, pos
+    elif code == 0xcb:
+        return unpack_d(buf, pos)[0], pos + 8
+    elif code == 0xd3:
+        return unpack_q(buf, pos)[0], pos + 8
+    elif code in (0xd9, 0xda, 0xdb, 0xc4, 0xc5, 0xc6):
+        if code in (0xd9, 0xc4):
+            n = byte_value(buf[pos])
+            pos += 1
+        elif code in (0xda, 0xc5):
+            n = unpack_H(buf, pos)[0]
+            pos += 2
+        else:
+            n = unpack_I(buf, pos)[0]
+            pos += 4
+        data = buf[pos:pos + n]
+        if code >= 0xd9:
+            return utf_8_decode(data, None, True)[0], pos + n
+        return data.tobytes(), pos + n
+    elif code in (0xdc, 0xdd):
+        if code == 0xdc:
+            return unpack_array(buf, pos + 2, unpack_H(buf, pos)[0])
+        return unpack_array(buf, pos + 4, unpack_I(buf, pos)[0])
+    elif 0xd4 <= code <= 0xd8 or 0xc7 <= code <= 0xc9:
+        if code >= 0xd4:
+            n = 1 << (code - 0xd4)
+        elif code == 0xc7:
+            n = byte_value(buf[pos])
+            pos += 1
+        elif code == 0xc8:
+            n = unpack_H(buf, pos)[0]
+            pos += 2
+        else:
+            n = unpack_I(buf, pos)[0]
+            pos += 4
+        ext_type = byte_value(buf[pos])
+        pos += 1
+        return unpack_ext(ext_type, buf[pos:pos + n]), pos + n
+    elif code == 0xcc:
+        return byte_value(buf[pos]), pos + 1
+    elif code == 0xcd:
+        return unpack_H(buf, pos)[0], pos + 2
+    elif code == 0xce:
+        return unpack_I(buf, pos)[0], pos + 4
+    elif code == 0xcf:
+        return unpack_Q(buf, pos)[0], pos + 8
+    elif code == 0xd0:
+        return unpack_b(buf, pos)[0], pos + 1
+    elif code == 0xd1:
+        return unpack_h(buf, pos)[0], pos + 2
+    elif code == 0xd2:
+        return unpack_i(buf, pos)[0], pos + 4
+    elif code == 0xca:
+        return struct.unpack_from('>f', buf, pos)[0], pos + 4
+    raise Exception('Unsupported type byte 0x%02x at %d' % (code, pos - 1))
+
+
+def unpack_array(buf, pos, n):
+    items = [None] * n
+    for k in range(n):
+        # Fast paths for slot references and small ints, the bulk of lists
+        code = byte_value(buf[pos])
+        if code == 0xd6 and byte_value(buf[pos + 1]) == EXT_REF:
+            items[k] = [unpack_I(buf, pos + 2)[0]]
+            pos += 6
+        elif code < 0x80:
+            items[k] = code
+            pos += 1
+        else:
+            items[k], pos = unpack_value(buf, pos)
+    return items, pos
+
+
+def unpack_ext(ext_type, data):
+    if ext_type == EXT_REF:
+        if len(data) == 4:
+            return [unpack_I(data, 0)[0]]
+        return [unpack_Q(data, 0)[0]]
+    elif ext_type == EXT_TAG:
+        return 'py/' + utf_8_decode(data, None, True)[0]
+    elif ext_type == EXT_BUFFER:
+        return data
+    elif ext_type == EXT_BIGINT:
+        v = 0
+        for b in bytearray(data):
+            v = (v << 8) | b
+        if len(data) and byte_value(data[0]) & 0x80:
+            v -= 1 << (8 * len(data))
+        return v
+    raise Exception('Unknown extension type %d' % ext_type)
+
+
+def unpack_slots(data):
+    buf = memoryview(data)
+    slots, pos = unpack_value(buf, 0)
+    if not isinstance(slots, list):
+        raise Exception('Not a slot table')
+    if pos != len(buf):
+        raise Exception('Trailing data after the slot table')
+    return slots
+
+
+def dumps(obj, encoders = {}, **options):
+    slots = BinaryPreEncoder(encoders, **options).encode(obj)
+    return b''.join(pack_slots(slots))
+
+
+def dump(obj, fileobj, encoders = {}, **options):
+    slots = BinaryPreEncoder(encoders, **options).encode(obj)
+    for piece in pack_slots(slots):
+        fileobj.write(piece)
+
+
+# ndarrays come back as views onto data: read-only for bytes input, writable
+# when data is a bytearray.
+def loads(data, decoders = {}):
+    return BinaryPostDecoder(decoders).decode(unpack_slots(data))
+
+
+def load(fileobj, decoders = {}):
+    return loads(fileobj.read(), decoders)
@@ -0,0 +1,121 @@
+from __future__ import print_function
+
+import json
+import mmap
+import struct
+
+from . import PreEncoder, PostDecoder, string_formats
+from .lazy import LazyDecoder
+
+'''
+Single-file container with memory-mapped data.
+
+Layout:
+- header: magic, then table_offset, table_size, index_offset, n_buffers and
+  the string format of the slot table (its index in string_formats) as
+  big-endian unsigned 64 bit ints
+- the slot table as utf8 JSON
+- the offset index: (offset, size) of every buffer, big-endian unsigned 64
+  bit ints
+- the data section: the buffers handed out by the encoders (ndarray data,
+  compressed chunks, bytes with the 'buffer' strategy), each starting at a
+  multiple of data_alignment
+
+Buffers go into the data section through PreEncoder's buffer_callback, so the
+slot table only refers to them by their index. load memory-maps the file and
+hands the decoders memoryviews onto the mapping: ndarrays become np.frombuffer
+views of the file and only the slot table is actually read.
+'''
+
+magic = b'P23S\x00\x00\x00\x01'
+header = struct.Struct('>8sQQQQQ')
+index_entry = struct.Struct('>QQ')
+data_alignment = max(mmap.PAGESIZE, 4096)
+
+# Buffers smaller than this stay in the slot table
+inline_max = 256
+
+
+def align(n, alignment = data_alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+
+# fileobj has to be opened in binary mode. encoders and options are the same
+# as for PreEncoder (except buffer_callback, which the container provides).
+def dump(obj, fileobj, encoders = {}, **options):
+    buffers = []
+    def buffer_callback(buf):
+        if buf.nbytes < inline_max:
+            return True
+        buffers.append(buf)
+        return False
+    slots = PreEncoder(encoders, buffer_callback = buffer_callback,
+        **options).encode(obj)
+    table = json.dumps(slots).encode('utf8')
+    table_offset = header.size
+    index_offset = table_offset + len(table)
+    offset = index_offset + index_entry.size * len(buffers)
+    index = []
+    for buf in buffers:
+        offset = align(offset)
+        index.append(index_entry.pack(offset, buf.nbytes))
+        offset += buf.nbytes
+    fileobj.write(header.pack(magic, table_offset, len(table), index_offset,
+        len(buffers), string_formats.index(
+            options.get('string_format', 'prefixed'))))
+    fileobj.write(table)
+    fileobj.write(b''.join(index))
+    pos = index_offset + index_entry.size * len(buffers)
+    for buf in buffers:
+        padding = align(pos) - pos
+        fileobj.write(b'\0' * padding)
+        fileobj.write(buf)
+        pos += padding + buf.nbytes
+
+
+def dump_file(obj, path, encoders = {}, **options):
+    with open(path, 'wb') as f:
+        dump(obj, f, encoders, **options)
+
+
+# Opens the container at path (or an open binary file object). Arrays are
+# read-only views onto the file unless writable is true, in which case the
+# mapping is copy-on-write: changes are never written back. With lazy true,
+# returns LazyDecoder proxies (see the lazy module). The string format is
+# read from the file; if string_format is given, it has to match.
+def load(path, decoders = {}, writable = False, lazy = False,
+        string_format = None):
+    if hasattr(path, 'fileno'):
+        mapping = mmap.mmap(path.fileno(), 0,
+            access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ)
+    else:
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0,
+                access = mmap.ACCESS_COPY if writable else mmap.ACCESS_READ)
+    view = memoryview(mapping)
+    if len(view) < header.size:
+        raise Exception('Not a container file (too short)')
+    (file_magic, table_offset, table_size, index_offset, n_buffers,
+        format_code) = header.unpack_from(view, 0)
+    if file_magic != magic:
+        raise Exception('Not a container file (bad magic)')
+    if format_code >= len(string_formats):
+        raise Exception('Unknown string format %d' % format_code)
+    file_format = string_formats[format_code]
+    if string_format is not None and string_format != file_format:
+        raise Exception('Container has string format %r, not %r'
+            % (file_format, string_format))
+    if index_offset + index_entry.size * n_buffers > len(view):
+        raise Exception('Truncated container file')
+    slots = json.loads(
+        view[table_offset:table_offset + table_size].tobytes().decode('utf8'))
+    buffers = []
+    for k in range(n_buffers):
+        offset, size = index_entry.unpack_from(
+            view, index_offset + index_entry.size * k)
+        if offset + size > len(view):
+            raise Exception('Truncated container file')
+        buffers.append(view[offset:offset + size])
+    decoder_class = LazyDecoder if lazy else PostDecoder
+    return decoder_class(decoders, buffers,
+        string_format = file_format).decode(slots)
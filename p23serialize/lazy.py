@@ -0,0 +1,193 @@
+from __future__ import print_function
+
+try:
+    from collections.abc import MutableMapping, MutableSequence
+except ImportError:  # python2
+    from collections import MutableMapping, MutableSequence
+try:
+    from reprlib import recursive_repr
+except ImportError:  # python2
+    def recursive_repr():
+        return lambda fn: fn
+
+from . import PostDecoder, COMPACT_DICT, TEMPLATE_DICT
+
+'''
+Lazy, random-access decoding.
+
+LazyDecoder.decode returns proxies for lists and dicts instead of decoding the
+whole slot table. A proxy decodes its own slot the first time it is used; the
+lists and dicts it contains are proxies again, so only the parts of the object
+graph that are actually touched get decoded. Every slot is decoded at most once,
+so shared and circular references keep their identity.
+
+Strings and basic types are decoded on access. Custom objects (tuple, ndarray,
+...) need their encoder params, so they are decoded eagerly, together with the
+lists and dicts below them that are not proxies yet.
+
+Proxies behave like lists/dicts (MutableSequence/MutableMapping) but are not
+list/dict instances, so e.g. json.dumps cannot serialize them.
+'''
+
+
+# Slot arrays for LazyDecoder: sparse, since most slots are never touched
+class SparseSlots(dict):
+    def __missing__(self, idx):
+        return None
+
+
+class LazyList(MutableSequence):
+    __slots__ = ('_decoder', '_idx', '_items')
+
+    def __init__(self, decoder, idx):
+        self._decoder = decoder
+        self._idx = idx
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            self._items = self._decoder.load_list(self._idx)
+            self._decoder = None
+        return self._items
+
+    def __getitem__(self, k):
+        return self._load()[k]
+
+    def __setitem__(self, k, value):
+        self._load()[k] = value
+
+    def __delitem__(self, k):
+        del self._load()[k]
+
+    def __len__(self):
+        return len(self._load())
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def insert(self, k, value):
+        self._load().insert(k, value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyList):
+            other = other._load()
+        return self._load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    @recursive_repr()
+    def __repr__(self):
+        return repr(self._load())
+
+
+class LazyDict(MutableMapping):
+    __slots__ = ('_decoder', '_idx', '_items')
+
+    def __init__(self, decoder, idx):
+        self._decoder = decoder
+        self._idx = idx
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            self._items = self._decoder.load_dict(self._idx)
+            self._decoder = None
+        return self._items
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __contains__(self, key):
+        return key in self._load()
+
+    def __len__(self):
+        return len(self._load())
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyDict):
+            other = other._load()
+        return self._load() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    @recursive_repr()
+    def __repr__(self):
+        return repr(self._load())
+
+
+class LazyDecoder(PostDecoder):
+
+    def decode(self, encoded_list):
+        self.encoded = encoded_list
+        self.raws = SparseSlots()
+        self.done = bytearray(len(encoded_list))
+        self.deserializers_for = None
+        self.deserializers = SparseSlots()
+        if self.string_format == 'native':
+            self.decode_bytes_slots()
+        return self.get(0)
+
+    # Decoded object of slot idx: a proxy for lists and dicts
+    def get(self, idx):
+        if self.done[idx]:
+            return self.raws[idx]
+        encoded = self.encoded[idx]
+        if isinstance(encoded, list):
+            deserializer = self.deserializers[idx]
+            if deserializer is None:
+                deserializer = self.calculate_deserializer(encoded)
+                self.deserializers[idx] = deserializer
+            decoder_init_fn = deserializer[0]
+            if not decoder_init_fn:
+                proxy = LazyList(self, idx)
+            elif decoder_init_fn in (dict, COMPACT_DICT, TEMPLATE_DICT):
+                proxy = LazyDict(self, idx)
+            else:
+                proxy = None
+            if proxy is not None:
+                self.done[idx] = 1
+                self.raws[idx] = proxy
+                return proxy
+        self.walk(idx)
+        return self.raws[idx]
+
+    def get_item(self, item):
+        if not isinstance(item, list):
+            return item  # basic type
+        return self.get(item[0])
+
+    def load_list(self, idx):
+        get_item = self.get_item
+        return [get_item(item) for item in self.encoded[idx]]
+
+    def load_dict(self, idx):
+        get_item = self.get_item
+        encoded = self.encoded[idx]
+        raw = {}
+        if self.deserializers[idx][0] == COMPACT_DICT:
+            for k in range(1, len(encoded), 2):
+                raw[get_item(encoded[k])] = get_item(encoded[k + 1])
+        elif self.deserializers[idx][0] == TEMPLATE_DICT:
+            keys = get_item(encoded[1])
+            for k, key in enumerate(keys):
+                raw[key] = get_item(encoded[k + 2])
+        else:
+            for kv_idx in encoded[1:]:
+                key, value = self.encoded[kv_idx]
+                raw[get_item(key)] = get_item(value)
+        return raw
@@ -0,0 +1,349 @@
+from __future__ import print_function
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from . import (
+    PreEncoder, PostDecoder, str_types, force_str_type0, compact_dict_tag,
+    packed_list_tag, template_dict_tag)
+from .lazy import SparseSlots
+
+'''
+Parallel encoding and decoding of large top-level lists across processes
+(python 3.7+, not imported by the package itself).
+
+encode splits the items of a list into chunks and encodes every chunk with
+its own PreEncoder in a process pool. The merged slot table is slot 0 (the
+list) followed by the slots of every chunk, their references shifted to
+where the chunk ends up. Every chunk is encoded once; the calling process
+shifts the references of each chunk's table in place as it arrives (in
+order), while the workers go on with the later chunks.
+
+decode finds the slots reachable from every chunk of the root list's items,
+then decodes the chunks in the pool and puts the items back into one list.
+It works on any slot table whose root is a plain list.
+
+The pool's processes get the list or slot table once, when they start (no
+copy at all with the 'fork' start method). Items, encoders and decoders have
+to be picklable.
+
+Chunks must not share objects, as every process builds its own. decode
+checks this by following the slot references: chunks that reach a common
+slot are decoded together. encode does the same with a pre-pass over ids
+(check_shared) that follows lists, dicts, tuples, sets and frozensets,
+subclasses included, and object arrays. ndarrays of other dtypes,
+memoryviews and datetimes are compared as a whole. Objects of any other
+type could refer to anything through their encoder, so they make encode
+fall back to a single PreEncoder, as does anything that refers back to the
+top-level list (decode falls back to a single PostDecoder for the latter).
+Pass check_shared = False to either of them if the items are known to be
+independent, and not to refer back to the list: the check is a serial pass
+over everything.
+
+The merged table is valid for PostDecoder. Equal immutable values in
+different chunks get a slot per chunk: interned strings and tuples, and
+dict_templates shapes. buffer_callback and stats cannot be used, as their
+results would stay in the worker processes.
+'''
+
+# Lists shorter than this are encoded/decoded in the calling process, as is
+# everything when there is only one process
+parallel_min = 1000
+
+# Types of values that never need their own slot, or are immutable and so
+# may be copied freely (tuple and frozenset contents are still checked)
+atomic_types = frozenset((int, float, bool, type(None)) + str_types)
+
+# How shared_groups checks objects of a type (see walk_kind)
+WALK_ATOM = 0  # not at all
+WALK_ITEMS = 1  # only its items (immutable containers)
+WALK_SHARED = 2  # by id, then its items
+WALK_WHOLE = 3  # by id only, it refers to no other objects
+WALK_ARRAY = 4  # by id, then its items for object arrays
+walk_kinds = {tuple: WALK_ITEMS, frozenset: WALK_ITEMS, list: WALK_SHARED,
+    set: WALK_SHARED, dict: WALK_SHARED, memoryview: WALK_WHOLE}
+for _t in atomic_types:
+    walk_kinds[_t] = WALK_ATOM
+del _t
+# By 'module.name', so that their modules need not be imported
+walk_kinds_by_name = {'numpy.generic': WALK_ATOM, 'numpy.ndarray': WALK_ARRAY,
+    'datetime.datetime': WALK_WHOLE}
+walk_kinds_cache = {}
+
+
+# How shared_groups checks objects of type t: found via t's MRO like
+# PreEncoder.resolve_dispatch, so subclasses (OrderedDict, namedtuples...)
+# are checked like their base. None if objects of type t cannot be checked.
+def walk_kind(t):
+    try:
+        return walk_kinds_cache[t]
+    except KeyError:
+        pass
+    kind = None
+    for cls in getattr(t, '__mro__', (t,)):
+        kind = walk_kinds.get(cls)
+        if kind is None:
+            kind = walk_kinds_by_name.get(
+                '%s.%s' % (cls.__module__, cls.__name__))
+        if kind is not None:
+            break
+    walk_kinds_cache[t] = kind
+    return kind
+
+# Tags of the slots whose items are stored like list items: basic values as
+# they are, references to other slots as [idx]. Dict and custom slots hold
+# plain slot indices after their tag.
+list_like_tags = (compact_dict_tag, template_dict_tag)
+
+
+def n_processes(processes):
+    return processes or os.cpu_count() or 1
+
+
+def default_chunk_size(n, processes):
+    processes = n_processes(processes)
+    # A few chunks per process, so uneven chunks still keep them all busy
+    return max(n // (4 * processes), 1)
+
+
+def chunk_ranges(n, chunk_size):
+    return [(a, min(a + chunk_size, n)) for a in range(0, n, chunk_size)]
+
+
+# Slot indices that slot (an entry of a slot table) refers to
+def slot_refs(slot):
+    if type(slot) is not list or not slot:
+        return ()
+    head = slot[0]
+    if isinstance(head, str_types):
+        tag = force_str_type0(head)
+        if tag == packed_list_tag:
+            return slot[2]
+        if not tag in list_like_tags:
+            return slot[1:]
+        slot = slot[1:]
+    return [item[0] for item in slot if type(item) is list]
+
+
+# Adds shift to every reference of the slots of table, in place. PreEncoder
+# makes a new [idx] list for every reference, so none is shifted twice.
+def shift_slots(table, shift):
+    for slot in table:
+        if type(slot) is not list or not slot:
+            continue
+        head = slot[0]
+        if isinstance(head, str_types):
+            tag = force_str_type0(head)
+            if tag == packed_list_tag:
+                slot[2][0] += shift
+                continue
+            if not tag in list_like_tags:
+                for k in range(1, len(slot)):
+                    slot[k] += shift
+                continue
+        for item in slot:
+            if type(item) is list:
+                item[0] += shift
+
+
+# Union-find over chunk numbers: chunks that share something are grouped
+def find(parents, c):
+    while parents[c] != c:
+        parents[c] = parents[parents[c]]
+        c = parents[c]
+    return c
+
+
+def union(parents, c0, c1):
+    c0 = find(parents, c0)
+    c1 = find(parents, c1)
+    if c0 != c1:
+        parents[max(c0, c1)] = min(c0, c1)
+
+
+# Item positions of every group of chunks, in chunk order
+def group_positions(ranges, parents):
+    groups = {}  # first chunk of the group:item positions
+    for c, (a, b) in enumerate(ranges):
+        groups.setdefault(find(parents, c), []).extend(range(a, b))
+    return [groups[c] for c in sorted(groups)]
+
+
+# Groups the chunks (item ranges) of obj by the mutable objects they share.
+# Returns the item positions of every group, None when an item refers back
+# to obj itself or cannot be checked (see walk_kind).
+def shared_groups(obj, ranges):
+    owners = {id(obj): -1}  # id:first chunk that reached the object
+    parents = list(range(len(ranges)))
+    for c, (a, b) in enumerate(ranges):
+        stack = obj[a:b]
+        while stack:
+            item = stack.pop()
+            t = type(item)
+            if t in atomic_types:
+                continue
+            kind = walk_kinds_cache.get(t)
+            if kind is None:
+                kind = walk_kind(t)
+                if kind is None:
+                    return None
+            if kind == WALK_ATOM:
+                continue
+            if kind == WALK_ITEMS:
+                stack.extend(item)
+                continue
+            owner = owners.get(id(item))
+            if owner is not None:
+                if owner < 0:
+                    return None
+                union(parents, owner, c)
+                continue
+            owners[id(item)] = c
+            if kind == WALK_SHARED:
+                if isinstance(item, dict):
+                    stack.extend(item.keys())
+                    stack.extend(item.values())
+                else:
+                    stack.extend(item)
+            elif kind == WALK_ARRAY and item.dtype.hasobject:
+                stack.extend(item.ravel().tolist())
+    return group_positions(ranges, parents)
+
+
+# Same for the root list of a slot table, by following slot references.
+# n_slots excludes the bytes slots list of the 'native' string format.
+def shared_slot_groups(slots, n_slots, ranges):
+    root = slots[0]
+    owners = [-1] * n_slots  # first chunk that reached the slot
+    owners[0] = -2  # the root itself
+    parents = list(range(len(ranges)))
+    for c, (a, b) in enumerate(ranges):
+        stack = [item[0] for item in root[a:b] if type(item) is list]
+        while stack:
+            idx = stack.pop()
+            owner = owners[idx]
+            if owner == -1:
+                owners[idx] = c
+                stack.extend(slot_refs(slots[idx]))
+            elif owner == -2:
+                return None
+            elif owner != c:
+                union(parents, owner, c)
+    return group_positions(ranges, parents)
+
+
+# State of a worker process: the list or slot table and codecs, see
+# make_pool
+worker_state = {}
+
+
+def init_worker(state):
+    worker_state.update(state)
+
+
+def make_pool(processes, **state):
+    return ProcessPoolExecutor(processes, initializer = init_worker,
+        initargs = (state,))
+
+
+# Slot table of the items at positions of the worker's list, and the list of
+# its bytes slots ('native' string format, empty otherwise)
+def encode_chunk(positions):
+    obj = worker_state['obj']
+    options = worker_state['options']
+    table = PreEncoder(worker_state['encoders'], **options).encode(
+        [obj[k] for k in positions])
+    bytes_slots = []
+    if options.get('string_format') == 'native':
+        bytes_slots = table.pop()
+    return table, bytes_slots
+
+
+# Decoded items at positions of the worker's slot table root list
+def decode_chunk(positions):
+    slots = worker_state['slots']
+    decoder = PostDecoder(worker_state['decoders'],
+        string_format = worker_state['string_format'])
+    # Only the chunk's slots get decoded, so sparse like LazyDecoder's
+    decoder.encoded = slots
+    decoder.raws = SparseSlots()
+    decoder.done = bytearray(len(slots))
+    decoder.deserializers_for = None
+    decoder.deserializers = SparseSlots()
+    if decoder.string_format == 'native':
+        decoder.decode_bytes_slots()
+    root = slots[0]
+    items = []
+    for k in positions:
+        item = root[k]
+        if type(item) is list:
+            decoder.walk(item[0])
+            item = decoder.raws[item[0]]
+        items.append(item)
+    return items
+
+
+# Encode obj (a list; anything else is encoded by one PreEncoder) in a pool
+# of processes. options are passed on to PreEncoder.
+def encode(obj, encoders = {}, processes = None, chunk_size = None,
+        check_shared = True, **options):
+    if options.get('buffer_callback') or options.get('stats'):
+        raise Exception('buffer_callback and stats need a single PreEncoder')
+    if (type(obj) is not list or len(obj) < parallel_min
+            or n_processes(processes) < 2):
+        return PreEncoder(encoders, **options).encode(obj)
+    ranges = chunk_ranges(len(obj),
+        chunk_size or default_chunk_size(len(obj), processes))
+    if check_shared:
+        groups = shared_groups(obj, ranges)
+        if groups is None:
+            return PreEncoder(encoders, **options).encode(obj)
+    else:
+        groups = [list(range(a, b)) for a, b in ranges]
+    root = [None] * len(obj)
+    slots = [root]
+    bytes_slots = []
+    with make_pool(processes, obj = obj, encoders = encoders,
+            options = options) as pool:
+        for positions, (table, chunk_bytes_slots) in zip(groups,
+                pool.map(encode_chunk, groups)):
+            # Slot k > 0 of the chunk becomes len(slots) + k - 1; slot 0 is
+            # the chunk's list, whose items go into the merged root list.
+            shift = len(slots) - 1
+            shift_slots(table, shift)
+            for k, item in zip(positions, table[0]):
+                root[k] = item
+            slots.extend(table[1:])
+            bytes_slots.extend([idx + shift for idx in chunk_bytes_slots])
+    if options.get('string_format') == 'native':
+        slots.append(bytes_slots)
+    return slots
+
+
+# Decode slots (a slot table) in a pool of processes, see encode. Slot tables
+# whose root is not a plain list are decoded by one PostDecoder.
+def decode(slots, decoders = {}, processes = None, chunk_size = None,
+        string_format = 'prefixed', check_shared = True):
+    root = slots[0] if slots else None
+    groups = None
+    if (type(root) is list and len(root) >= parallel_min
+            and n_processes(processes) > 1 and not (root and isinstance(root[0], str_types))):
+        n_slots = len(slots)
+        if string_format == 'native':
+            n_slots -= 1
+        ranges = chunk_ranges(len(root),
+            chunk_size or default_chunk_size(len(root), processes))
+        if check_shared:
+            groups = shared_slot_groups(slots, n_slots, ranges)
+        else:
+            groups = [list(range(a, b)) for a, b in ranges]
+    if groups is None:
+        return PostDecoder(decoders, string_format = string_format).decode(
+            slots)
+    obj = [None] * len(root)
+    with make_pool(processes, slots = slots, decoders = decoders,
+            string_format = string_format) as pool:
+        for positions, items in zip(groups, pool.map(decode_chunk, groups)):
+            for k, item in zip(positions, items):
+                obj[k] = item
+    return obj
@@ -0,0 +1,71 @@
+from __future__ import print_function
+
+from . import (
+    encode_tuple, decode_tuple, encode_np_ndarray, decode_np_ndarray_init,
+    decode_np_ndarray_final, encode_bytes, decode_bytes, encode_unicode,
+    decode_unicode, encode_set, decode_set, decode_frozenset, encode_datetime,
+    decode_datetime)
+from .util import unicode_type
+
+'''
+Registry of the built-in codecs, and default encoder/decoder settings made
+from it:
+    encoded = PreEncoder(default_encode_settings).encode(obj)
+    obj = PostDecoder(default_decode_settings).decode(encoded)
+
+Types whose module is slow to import are registered by their 'module.name'
+(see PreEncoder.resolve_dispatch), and their codecs import what they need
+when first called. Using the defaults does not import numpy until an
+ndarray is actually encoded or decoded.
+
+The unicode codec encodes strings as utf8 bytes, and the bytes codec encodes
+bytes as (unicode) strings, so the two cannot be used together. The default
+encoder settings leave out the unicode codec; its decoder is always included.
+'''
+
+# name:(type or 'module.name', encoder function, decoder init function,
+# decoder final function)
+codecs = {
+    'tuple': (tuple, encode_tuple, decode_tuple, None),
+    'np_ndarray': ('numpy.ndarray', encode_np_ndarray, decode_np_ndarray_init,
+        decode_np_ndarray_final),
+    'bytes': (bytes, encode_bytes, decode_bytes, None),
+    'unicode': (unicode_type, encode_unicode, decode_unicode, None),
+    'set': (set, encode_set, decode_set, None),
+    'frozenset': (frozenset, encode_set, decode_frozenset, None),
+    'datetime': ('datetime.datetime', encode_datetime, decode_datetime, None),
+}
+
+default_codecs = ('tuple', 'np_ndarray', 'bytes', 'set', 'frozenset',
+    'datetime')
+
+
+# Add (or replace) a codec. t is a type or a 'module.name' string.
+def register(name, t, encoder_fn, decoder_init_fn, decoder_final_fn = None):
+    codecs[name] = (t, encoder_fn, decoder_init_fn, decoder_final_fn)
+
+
+# Encoders dictionary for PreEncoder with the codecs names (all of
+# default_codecs by default)
+def encode_settings(names = default_codecs):
+    settings = {}
+    for name in names:
+        t, encoder_fn, _, _ = codecs[name]
+        settings[t] = (name, encoder_fn)
+    return settings
+
+
+# Decoders dictionary for PostDecoder with the codecs names (all codecs by
+# default)
+def decode_settings(names = None):
+    if names is None:
+        names = codecs.keys()
+    settings = {}
+    for name in names:
+        _, _, decoder_init_fn, decoder_final_fn = codecs[name]
+        settings[name] = (decoder_init_fn, decoder_final_fn)
+    return settings
+
+
+default_encode_settings = encode_settings()
+default_decode_settings = decode_settings()
@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+from . import PreEncoder, PostDecoder, str_types
+
+'''
+Sessions: one encoder and one decoder for a whole stream of messages.
+
+SessionEncoder/SessionDecoder are reused for every message, so per-type
+dispatch, encoder tables and the decoder's tag table are built once per
+session instead of once per message. Both ends also keep a shared table of
+short strings: every string slot of a message (at most max_string_len long)
+is added to the table once the message is done, up to max_strings entries.
+Later messages refer to such strings instead of repeating them.
+
+A message is [epoch, base, slots]:
+- slots: the slot table, except that string j of the session table is
+  referenced as slot j - base (a negative index)
+- base: the session table size the message was encoded against
+- epoch: counts the encoder's resets. A message with a new epoch makes the
+  decoder start over with an empty table.
+The table stops growing at max_strings; call SessionEncoder.reset to start
+over (e.g. periodically, or when the peer reconnects). Messages have to be
+decoded in the order they were encoded, and both ends need the same
+max_strings/max_string_len.
+'''
+
+
+class SessionEncoder(PreEncoder):
+
+    # options are passed on to PreEncoder
+    def __init__(self, encoders = {}, max_strings = 1 << 12,
+            max_string_len = 64, **options):
+        PreEncoder.__init__(self, encoders, **options)
+        if self.bytes_slots is not None:
+            raise Exception('Sessions need the prefixed string format')
+        self.max_strings = max_strings
+        self.max_string_len = max_string_len
+        self.epoch = 0
+        self.strings = {}  # encoded string:index in the session table
+        self.base = 0
+
+    def reset(self):
+        self.epoch += 1
+        self.strings = {}
+
+    def intern_slot(self, obj, new_idx):
+        if type(obj) in str_types:
+            j = self.strings.get(self.encode_str(obj))
+            if j is not None:
+                return j - self.base
+        if not self.intern_types:
+            return None
+        return PreEncoder.intern_slot(self, obj, new_idx)
+
+    # Returns the message for obj
+    def encode(self, obj):
+        self.ids.clear()
+        self.encoded = []
+        self.raws = []
+        self.interned = {}  # walk only calls intern_slot when not None
+        self.templates = {}
+        self.n_buffers = 0
+        self.base = len(self.strings)
+        if self.walk(obj) < 0:
+            # The root itself is a session string
+            self.encoded.append(self.encode_str(obj))
+        slots = self.encoded
+        add_strings(self.strings, slots, self.max_strings, self.max_string_len)
+        self.encoded = []
+        self.raws = []
+        self.ids.clear()
+        return [self.epoch, self.base, slots]
+
+
+# Adds the string slots of a message to the session table strings (encoded
+# string:index), in slot order. Returns the new strings.
+def add_strings(strings, slots, max_strings, max_string_len):
+    added = []
+    for encoded in slots:
+        if len(strings) >= max_strings:
+            break
+        if (isinstance(encoded, str_types) and len(encoded) <= max_string_len
+                and not encoded in strings):
+            strings[encoded] = len(strings)
+            added.append(encoded)
+    return added
+
+
+class SessionDecoder(PostDecoder):
+
+    def __init__(self, decoders = {}, max_strings = 1 << 12,
+            max_string_len = 64, **options):
+        PostDecoder.__init__(self, decoders, **options)
+        if self.string_format != 'prefixed':
+            raise Exception('Sessions need the prefixed string format')
+        self.max_strings = max_strings
+        self.max_string_len = max_string_len
+        self.epoch = 0
+        self.reset()
+
+    def reset(self):
+        self.strings = {}  # encoded string:index in the session table
+        self.session_raws = []  # decoded strings of the session table
+        # raws/done are kept from message to message: the first capacity
+        # entries are for the message's slots, session string j follows at
+        # capacity + j. A reference j - base then indexes it from the end,
+        # and a message only has to reset its own slots.
+        self.capacity = 0
+        self.raws = []
+        self.done = bytearray()
+
+    # Makes room for a message of n slots in front of the session strings
+    def grow(self, n):
+        extra = max(n - self.capacity, self.capacity)
+        self.raws[self.capacity:self.capacity] = [None] * extra
+        self.done[self.capacity:self.capacity] = bytearray(extra)
+        self.capacity += extra
+
+    def decode(self, message):
+        epoch, base, slots = message
+        if epoch != self.epoch:
+            self.reset()
+            self.epoch = epoch
+        if base != len(self.session_raws):
+            raise Exception('Session out of sync: message needs %d strings, '
+                'have %d' % (base, len(self.session_raws)))
+        n = len(slots)
+        if n > self.capacity:
+            self.grow(n)
+        self.encoded = slots
+        self.deserializers_for = None
+        self.deserializers = [None] * n
+        try:
+            self.walk(0)
+            root = self.raws[0]
+        finally:
+            # Drop the message's objects, ready for the next one
+            self.raws[:n] = [None] * n
+            self.done[:n] = bytearray(n)
+        for encoded in add_strings(self.strings, slots, self.max_strings,
+                self.max_string_len):
+            raw = self.decode_str(encoded)
+            self.session_raws.append(raw)
+            self.raws.append(raw)
+            self.done.append(1)
+        return root
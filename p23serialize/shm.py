@@ -0,0 +1,163 @@
+from multiprocessing import resource_tracker, shared_memory
+
+from . import PreEncoder, PostDecoder
+
+'''
+Shared memory transport between processes (python 3.8+, not imported by the
+package itself).
+
+ShmEncoder.encode copies every buffer an encoder hands out (ndarray data,
+compressed chunks, bytes with the 'buffer' strategy) into one
+multiprocessing.shared_memory segment per message. The message is
+[segment name, index, string format, slots]: the slot table refers to
+buffers by their number, index holds the [offset, size] of each one in the
+segment, and the string format is the slot table's (see PreEncoder). It is
+small and picklable, e.g. for a multiprocessing.Queue. ShmDecoder.decode
+attaches the segment and decodes with views onto it, so ndarrays are not
+copied again. Messages without buffers, or with only empty ones, have no
+segment (name None).
+
+Lifecycle: the encoder owns the segments it creates. Once the receiver has
+decoded a message (attached the segment), ShmEncoder.release(message) unlinks
+the segment; the receiver's views stay valid. The memory is freed when the
+receiver calls ShmDecoder.release(message), which requires that the decoded
+arrays are not used anymore. Both classes are context managers that release
+all their segments on exit (close), and the resource tracker of the encoder's
+process unlinks whatever is left when it exits.
+
+The decoder does not register the segments it attaches with its own resource
+tracker (track=False), which would otherwise unlink them, or warn about them,
+when the decoder's process exits. Before python 3.13 that means unregistering
+right after attaching; pass track=True there if encoder and decoder share a
+resource tracker (e.g. the decoder's process started the encoder's with the
+'spawn' start method).
+'''
+
+# Offsets of the buffers within a segment are multiples of this
+buffer_alignment = 64
+
+
+def align(n, alignment = buffer_alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+
+class ShmEncoder():
+
+    # encoders and options are the same as for PreEncoder (except
+    # buffer_callback, which the transport provides).
+    def __init__(self, encoders = {}, **options):
+        self.encoders = encoders
+        self.options = options
+        self.segments = set()  # names of segments not released yet
+
+    def encode(self, obj):
+        buffers = []
+        slots = PreEncoder(self.encoders, buffer_callback = buffers.append,
+            **self.options).encode(obj)
+        string_format = self.options.get('string_format', 'prefixed')
+        if not buffers:
+            return [None, [], string_format, slots]
+        index = []
+        offset = 0
+        for buf in buffers:
+            offset = align(offset)
+            index.append([offset, buf.nbytes])
+            offset += buf.nbytes
+        if not offset:  # only empty buffers; a segment cannot be empty
+            return [None, index, string_format, slots]
+        segment = shared_memory.SharedMemory(create = True, size = offset)
+        try:
+            for buf, (offset, size) in zip(buffers, index):
+                segment.buf[offset:offset + size] = buf.cast('B')
+            name = segment.name
+            self.segments.add(name)
+        except:
+            segment.unlink()
+            raise
+        finally:
+            segment.close()
+        return [name, index, string_format, slots]
+
+    # Unlink the segment of message (a message or segment name)
+    def release(self, message):
+        name = message[0] if isinstance(message, list) else message
+        if not name in self.segments:
+            return
+        self.segments.discard(name)
+        try:
+            segment = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return
+        segment.close()
+        segment.unlink()
+
+    def close(self):
+        for name in list(self.segments):
+            self.release(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShmDecoder():
+
+    # decoders are the same as for PostDecoder
+    def __init__(self, decoders = {}, track = False):
+        self.decoders = decoders
+        self.track = track
+        self.segments = {}  # name:attached SharedMemory
+
+    def attach(self, name):
+        if self.track:
+            return shared_memory.SharedMemory(name)
+        try:
+            return shared_memory.SharedMemory(name, track = False)
+        except TypeError:  # before python 3.13
+            segment = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            return segment
+
+    def decode(self, message):
+        name, index, string_format, slots = message
+        buffers = [memoryview(b'')] * len(index)
+        if name is not None:
+            segment = self.segments.get(name)
+            if segment is None:
+                segment = self.attach(name)
+                self.segments[name] = segment
+            view = segment.buf
+            buffers = [view[offset:offset + size] for offset, size in index]
+        decoder = PostDecoder(self.decoders, buffers,
+            string_format = string_format)
+        obj = decoder.decode(slots)
+        # The decoder refers to itself through its 'buffer' decoder; drop the
+        # views it holds now rather than whenever the cycle is collected.
+        decoder.raws = []
+        decoder.buffers = []
+        return obj
+
+    # Detach from the segment of message (a message or segment name). The
+    # objects decoded from it must not be used anymore.
+    def release(self, message):
+        name = message[0] if isinstance(message, list) else message
+        segment = self.segments.pop(name, None)
+        if segment is None:
+            return
+        try:
+            segment.close()
+        except BufferError:
+            self.segments[name] = segment
+            raise Exception('Segment %s is still in use by decoded objects' % name)
+
+    def close(self):
+        for name in list(self.segments):
+            self.release(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
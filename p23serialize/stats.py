@@ -0,0 +1,209 @@
+from __future__ import print_function
+
+import json
+import time
+
+'''
+Opt-in statistics for PreEncoder and PostDecoder.
+
+Pass an EncodeStats/DecodeStats object as the stats option:
+    stats = EncodeStats()
+    encoded = PreEncoder(encoders, stats = stats).encode(obj)
+    print(stats.summary())
+
+attach replaces a few methods and tables of that one encoder/decoder instance
+with instrumented versions, so encoders/decoders without stats run exactly the
+same code as before.
+
+slot_callback, if given, is called for every slot walked: with (idx, obj) by
+PreEncoder (basic types stored in slots of their own excluded), with
+(idx, encoded) by PostDecoder.
+'''
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+# Size of a slot's encoding: its JSON length, or an estimate for backends
+# with native bytes (see binary.py)
+def encoded_size(value):
+    try:
+        return len(json.dumps(value))
+    except (TypeError, ValueError):
+        pass
+    if isinstance(value, list):
+        return sum(encoded_size(item) for item in value) + len(value) + 1
+    if isinstance(value, memoryview):
+        return value.nbytes
+    return len(value)
+
+
+# Dict of id:slot index that counts lookups and hits in stats. Every
+# encoder gets its own, only the counts are shared.
+class CountingIds(dict):
+
+    def __init__(self, stats):
+        dict.__init__(self)
+        self.stats = stats
+
+    def get(self, key, default = None):
+        idx = dict.get(self, key, default)
+        self.stats.lookups += 1
+        if idx is not None:
+            self.stats.hits += 1
+        return idx
+
+
+def count(counts, key, n = 1):
+    counts[key] = counts.get(key, 0) + n
+
+
+class EncodeStats():
+
+    def __init__(self, slot_callback = None):
+        self.slot_callback = slot_callback
+        self.type_counts = {}  # type:number of slots
+        self.codec_calls = {}  # encoder name:number of calls
+        self.codec_time = {}  # encoder name:cumulative seconds
+        self.codec_size = {}  # encoder name:encoded size of its slots
+        self.max_depth = 0
+        self.lookups = 0  # id lookups
+        self.hits = 0  # id lookups that found an already walked object
+
+    # Share of id lookups that found an already walked object
+    def hit_rate(self):
+        return self.hits / float(self.lookups) if self.lookups else 0.
+
+    def timed(self, name, encoder_func):
+        def timed_encoder(obj):
+            t0 = clock()
+            try:
+                return encoder_func(obj)
+            finally:
+                count(self.codec_time, name, clock() - t0)
+                count(self.codec_calls, name)
+        return timed_encoder
+
+    def attach(self, encoder):
+        encoder.ids = CountingIds(self)
+        encoder.encoders = dict((t, (name, self.timed(name, encoder_func)))
+            for t, (name, encoder_func) in encoder.encoders.items())
+        owners = {}  # idx:name of the encoder whose params the slot holds
+        enter = encoder.enter
+        walk = encoder.walk
+
+        def counting_enter(idx, obj, stack):
+            owner = owners.get(stack[-1][5]) if stack else None
+            pushed = enter(idx, obj, stack)
+            t = type(obj)
+            count(self.type_counts, t)
+            kind = encoder.dispatch[t]
+            if isinstance(kind, tuple):
+                owner = kind[0]
+            if owner is not None:
+                owners[idx] = owner
+            if len(stack) > self.max_depth:
+                self.max_depth = len(stack)
+            if self.slot_callback is not None:
+                self.slot_callback(idx, obj)
+            return pushed
+
+        # Encoded sizes are only known once the walk is done (and not at all
+        # when streaming, where finished slots are dropped)
+        def sizing_walk(obj):
+            owners.clear()
+            root = walk(obj)
+            for idx, name in owners.items():
+                if idx < len(encoder.encoded) and encoder.encoded[idx] is not None:
+                    count(self.codec_size, name,
+                        encoded_size(encoder.encoded[idx]))
+            return root
+
+        encoder.enter = counting_enter
+        encoder.walk = sizing_walk
+
+    def summary(self):
+        return {
+            'type_counts': dict((t.__name__, n)
+                for t, n in self.type_counts.items()),
+            'codec_calls': dict(self.codec_calls),
+            'codec_time': dict(self.codec_time),
+            'codec_size': dict(self.codec_size),
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': self.hit_rate(),
+            'max_depth': self.max_depth,
+        }
+
+
+class DecodeStats():
+
+    def __init__(self, slot_callback = None):
+        self.slot_callback = slot_callback
+        # kind:number of slots, kind is 'list', 'dict', 'str', the name of a
+        # basic type or 'py/<name>' for custom decoders
+        self.kind_counts = {}
+        self.codec_calls = {}  # tag:number of init and final calls
+        self.codec_time = {}  # tag:cumulative seconds
+        self.max_depth = 0
+
+    def timed(self, tag, decoder_fn):
+        if decoder_fn is None:
+            return None
+        def timed_decoder(*args):
+            t0 = clock()
+            try:
+                return decoder_fn(*args)
+            finally:
+                count(self.codec_time, tag, clock() - t0)
+                count(self.codec_calls, tag)
+        return timed_decoder
+
+    def attach(self, decoder):
+        from . import (
+            COMPACT_DICT, PACKED_LIST, TEMPLATE_DICT, str_types, force_str_type0)
+        wrapped = {}  # so both spellings of a tag share the wrappers
+        for tag, deserializer in decoder.tags.items():
+            decoder_init_fn, decoder_final_fn, deserial_obj = deserializer
+            if decoder_init_fn in (
+                    dict, COMPACT_DICT, PACKED_LIST, TEMPLATE_DICT):
+                continue
+            if not id(deserializer) in wrapped:
+                name = force_str_type0(tag)
+                wrapped[id(deserializer)] = (
+                    self.timed(name, decoder_init_fn),
+                    self.timed(name, decoder_final_fn), deserial_obj)
+            decoder.tags[tag] = wrapped[id(deserializer)]
+        enter = decoder.enter
+
+        def counting_enter(idx, stack):
+            pushed = enter(idx, stack)
+            encoded = decoder.encoded[idx]
+            if not isinstance(encoded, list):
+                if isinstance(encoded, str_types):
+                    kind = 'str'
+                else:
+                    kind = type(encoded).__name__
+            else:
+                decoder_init_fn = decoder.deserializers[idx][0]
+                if not decoder_init_fn:
+                    kind = 'list'
+                elif decoder_init_fn in (dict, COMPACT_DICT, TEMPLATE_DICT):
+                    kind = 'dict'
+                else:
+                    kind = force_str_type0(encoded[0])
+            count(self.kind_counts, kind)
+            if len(stack) > self.max_depth:
+                self.max_depth = len(stack)
+            if self.slot_callback is not None:
+                self.slot_callback(idx, encoded)
+            return pushed
+
+        decoder.enter = counting_enter
+
+    def summary(self):
+        return {
+            'kind_counts': dict(self.kind_counts),
+            'codec_calls': dict(self.codec_calls),
+            'codec_time': dict(self.codec_time),
+            'max_depth': self.max_depth,
+        }
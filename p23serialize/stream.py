@@ -0,0 +1,221 @@
+from __future__ import print_function
+
+import json
+import struct
+
+from . import (
+    PreEncoder, PostDecoder, str_types, COMPACT_DICT, PACKED_LIST, TEMPLATE_DICT,
+    unpack_list)
+
+'''
+Streaming encoding/decoding.
+
+StreamEncoder writes every slot as its own record as soon as the slot is
+final, so the full slot table never exists in memory. StreamDecoder reads the
+records back one at a time.
+
+Records:
+- [idx, encoded]: slot idx with the same encoding PreEncoder.encode would
+  put at position idx of its list.
+- ['fwd', idx, head]: forward declaration, see below.
+
+Slots are final in post-order: children before their parent, and the root
+(slot 0) is always the last record of a message. A reference can therefore
+only point at a slot that has not been sent yet when it refers back to one of
+its (still open) ancestors, i.e. for circular references. For those the
+encoder first sends a forward declaration so the decoder can create the
+object up front and fill it in place once its record arrives:
+- 'list' / 'dict': an empty list/dict
+- [tag, init_idx]: custom object, created with its init decoder from slot
+  init_idx (which has been sent already); the final decoder runs later.
+- None: a custom object referenced from its own init params. Just like with
+  PostDecoder, such references decode to None.
+
+Wire formats (fmt):
+- 'jsonl': one JSON document per line
+- 'prefixed': 4 byte big-endian length, followed by the JSON document
+'''
+
+formats = ('jsonl', 'prefixed')
+
+
+def write_record(fileobj, record, fmt = 'jsonl'):
+    payload = json.dumps(record).encode('utf8')
+    if fmt == 'jsonl':
+        fileobj.write(payload + b'\n')
+    elif fmt == 'prefixed':
+        fileobj.write(struct.pack('>I', len(payload)) + payload)
+    else:
+        raise Exception('Unknown stream format %r' % (fmt,))
+
+
+def read_records(fileobj, fmt = 'jsonl'):
+    if fmt == 'jsonl':
+        while True:
+            line = fileobj.readline()
+            if not line:
+                return
+            if line.strip():
+                yield json.loads(line.decode('utf8'))
+    elif fmt == 'prefixed':
+        while True:
+            header = fileobj.read(4)
+            if not header:
+                return
+            if len(header) < 4:
+                raise Exception('Truncated record header')
+            n = struct.unpack('>I', header)[0]
+            payload = fileobj.read(n)
+            if len(payload) < n:
+                raise Exception('Truncated record')
+            yield json.loads(payload.decode('utf8'))
+    else:
+        raise Exception('Unknown stream format %r' % (fmt,))
+
+
+class StreamEncoder(PreEncoder):
+
+    # Either give fileobj (opened in binary mode) to write records in format
+    # fmt, or record_callback to receive the records themselves. options are
+    # passed on to PreEncoder.
+    def __init__(self, encoders = {}, fileobj = None, fmt = 'jsonl',
+            record_callback = None, **options):
+        PreEncoder.__init__(self, encoders, **options)
+        if self.bytes_slots is not None:
+            raise Exception('Streams need the prefixed string format')
+        if record_callback is None:
+            if fileobj is None:
+                raise Exception('Need either fileobj or record_callback')
+            record_callback = lambda record: write_record(fileobj, record, fmt)
+        self.record_callback = record_callback
+
+    # Every call writes one self-contained message (slot numbering restarts).
+    # Returns the number of slots written.
+    def encode(self, obj):
+        self.ids.clear()
+        self.encoded = []
+        self.raws = []
+        self.open_frames = {}
+        self.declared = {}
+        self.templates = {}
+        if self.interned is not None:
+            self.interned = {}
+        self.emit = self.record_callback
+        try:
+            self.walk(obj)
+        finally:
+            self.emit = None
+        n_slots = len(self.encoded)
+        self.encoded = []
+        self.raws = []
+        self.ids.clear()
+        return n_slots
+
+
+class StreamDecoder(PostDecoder):
+
+    def __init__(self, decoders = {}, buffers = None):
+        PostDecoder.__init__(self, decoders, buffers)
+        self.reset()
+
+    def reset(self):
+        self.raws = {}  # idx:object, records arrive in post-order
+        self.declared = set()  # slots created by a forward declaration
+
+    def get_raw(self, idx):
+        try:
+            return self.raws[idx]
+        except KeyError:
+            raise Exception('Slot %d referenced before it was sent' % idx)
+
+    # Apply one record. Returns (True, obj) when it completed a message (the
+    # root object), (False, None) otherwise.
+    def feed(self, record):
+        raws = self.raws
+        if isinstance(record[0], str_types):
+            # Forward declaration
+            _, idx, head = record
+            if head == 'list':
+                raws[idx] = []
+            elif head == 'dict':
+                raws[idx] = {}
+            elif head is None:
+                raws[idx] = None
+            else:
+                (decoder_init_fn, decoder_final_fn, deserial_obj
+                    ) = self.calculate_deserializer(head)
+                raws[idx] = self.init_custom(decoder_init_fn, head[1])
+            self.declared.add(idx)
+            return False, None
+        idx, encoded = record
+        declared = idx in self.declared
+        if not isinstance(encoded, list):
+            if not isinstance(encoded, str_types):
+                # basic type
+                raw = encoded
+            else:
+                raw = self.decode_str(encoded)
+        else:
+            (decoder_init_fn, decoder_final_fn, deserial_obj
+                ) = self.calculate_deserializer(encoded)
+            if not decoder_init_fn:
+                # Plain list
+                raw = raws[idx] if declared else []
+                raw[:] = [item if not isinstance(item, list)
+                    else self.get_raw(item[0]) for item in encoded]
+            elif decoder_init_fn == dict:
+                # Dictionary
+                raw = raws[idx] if declared else {}
+                for kv_idx in encoded[1:]:
+                    key, value = self.get_raw(kv_idx)
+                    raw[key] = value
+            elif decoder_init_fn == COMPACT_DICT:
+                raw = raws[idx] if declared else {}
+                items = [item if not isinstance(item, list)
+                    else self.get_raw(item[0]) for item in encoded[1:]]
+                for k in range(0, len(items), 2):
+                    raw[items[k]] = items[k + 1]
+            elif decoder_init_fn == TEMPLATE_DICT:
+                raw = raws[idx] if declared else {}
+                items = [item if not isinstance(item, list)
+                    else self.get_raw(item[0]) for item in encoded[1:]]
+                raw.update(zip(items[0], items[1:]))
+            elif decoder_init_fn == PACKED_LIST:
+                raw = unpack_list(encoded[1], self.get_raw(encoded[2][0]))
+            else:
+                # Custom decoder
+                if not len(encoded) in (2, 3):
+                    raise Exception('Unexpected error on slot %d' % idx)
+                raw = raws[idx] if declared else None
+                if raw is None:
+                    raw = self.init_custom(decoder_init_fn, encoded[1])
+                if len(encoded) == 3:
+                    raw2 = decoder_final_fn(raw, self.get_raw(encoded[2]))
+                    if not raw is raw2:
+                        raise Exception('Object finalizer function must return the same object')
+        if declared:
+            self.declared.discard(idx)
+        if idx == 0:
+            self.reset()
+            return True, raw
+        raws[idx] = raw
+        return False, None
+
+    def init_custom(self, decoder_init_fn, init_idx):
+        raw = decoder_init_fn(self.get_raw(init_idx))
+        if raw is None:
+            raise Exception('Cannot provide init decoder that returns None')
+        return raw
+
+    # Decode the messages in fileobj one after the other.
+    def iter_decode(self, fileobj, fmt = 'jsonl'):
+        for record in read_records(fileobj, fmt):
+            done, obj = self.feed(record)
+            if done:
+                yield obj
+
+    # Decode the next message in fileobj.
+    def decode(self, fileobj, fmt = 'jsonl'):
+        for obj in self.iter_decode(fileobj, fmt):
+            return obj
+        raise Exception('End of stream before a complete message')
@@ -1,13 +1,44 @@
 
 from __future__ import print_function
 
+import base64
+import collections
+import io
+import json
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import numpy as np
 import p23serialize
 
 from p23serialize import (
     PreEncoder, PostDecoder, decode_bytes, encode_np_ndarray, decode_tuple,
     encode_tuple, decode_np_ndarray_init, decode_np_ndarray_final, encode_bytes,
-    encode_unicode, decode_unicode, str_mode)
+    encode_unicode, decode_unicode, str_mode, bytes_encoder, bytes_strategies,
+    np_ndarray_encoder, compression_codecs)
+from p23serialize.stream import StreamEncoder, StreamDecoder
+from p23serialize import binary
+from p23serialize.lazy import LazyDecoder
+from p23serialize import container
+from p23serialize.stats import EncodeStats, DecodeStats
+from p23serialize.session import SessionEncoder, SessionDecoder
+from p23serialize import registry
+try:
+    import asyncio
+    from p23serialize import aio
+except (ImportError, SyntaxError):  # python2
+    aio = None
+try:
+    from p23serialize import shm
+except ImportError:  # before python 3.8
+    shm = None
+try:
+    from p23serialize import parallel
+except ImportError:  # python2
+    parallel = None
 
 def run_tests():
     tests = []
@@ -164,6 +195,757 @@ def run_tests():
         assert id(data3) == id(data3[()][123])
     tests.append((test_circular_np, 'Encode circular numpy object array'))
 
+    def test_deep_nesting():
+        depth = 20000
+        data = [0]
+        for k in range(depth):
+            data = [k + 1, {'next': (data,)}]
+        data2 = PreEncoder(default_encode_settings).encode(data)
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        # Walk the chain by hand; == would recurse too deep
+        for k in range(depth, 0, -1):
+            assert data3[0] == k
+            data3 = data3[1]['next'][0]
+        assert data3 == [0]
+    tests.append((test_deep_nesting, 'Encode deeply nested data'))
+
+    def test_circular_list():
+        data = [1, {}]
+        data[1]['self'] = data
+        data.append(data)
+        data2 = PreEncoder(default_encode_settings).encode(data)
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        assert data3[0] == 1
+        assert data3[2] is data3
+        assert data3[1]['self'] is data3
+    tests.append((test_circular_list, 'Encode circular list'))
+
+    def test_np_out_of_band():
+        data = [np.arange(12.).reshape(3, 4), np.arange(6).reshape(2, 3).T]
+        buffers = []
+        def buffer_callback(buf):
+            buffers.append(buf)
+            return False
+        data2 = PreEncoder(default_encode_settings, buffer_callback).encode(
+            data)
+        assert len(buffers) == 2
+        assert ['py/buffer', data2.index(0)] in data2
+        assert ['py/buffer', data2.index(1)] in data2
+        data3 = PostDecoder(default_decode_settings, buffers).decode(data2)
+        assert (data3[0] == data[0]).all() and (data3[1] == data[1]).all()
+        # Contiguous (C or Fortran order) array data is shared, not copied
+        assert np.shares_memory(data3[0], data[0])
+        assert np.shares_memory(data3[1], data[1])
+        assert data3[1].flags.f_contiguous
+    tests.append((test_np_out_of_band, 'Encode numpy arrays out-of-band'))
+
+    def test_np_full_dtypes():
+        data = [
+            np.array([(1, [2.5, 3.], 'ab'), (3, [4.5, 5.], 'cd')],
+                dtype = [('a', '>i4'), ('b', '<f8', (2,)), ('c', 'U3')]),
+            np.array([(1, 2.)], dtype = {'names': ['x', 'y'],
+                'formats': ['<u2', '<f4'], 'offsets': [0, 8], 'itemsize': 16}),
+            np.arange(10, dtype = '>i2')[::2],
+            np.array(['a', 'bcd']),
+            np.arange(12.).reshape(3, 4).T,
+        ]
+        data2 = PreEncoder(default_encode_settings).encode(data)
+        data2 = json.loads(json.dumps(data2))
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        for a, b in zip(data, data3):
+            assert b.dtype == a.dtype and b.shape == a.shape
+            assert (b == a).all()
+        assert data3[4].flags.f_contiguous
+        # Object arrays of any shape, with references back to the array
+        data = np.empty((2, 2), dtype = 'object')
+        data[0, 0] = [1, 2]
+        data[0, 1] = None
+        data[1, 0] = data
+        data[1, 1] = data[0, 0]
+        data3 = PostDecoder(default_decode_settings).decode(
+            PreEncoder(default_encode_settings).encode(data))
+        assert data3.shape == (2, 2)
+        assert data3[0, 0] == [1, 2] and data3[0, 1] is None
+        assert data3[1, 0] is data3 and data3[1, 1] is data3[0, 0]
+    tests.append((test_np_full_dtypes, 'Encode structured, byte-swapped, '
+        'Fortran order and object arrays'))
+
+    def test_np_non_contiguous():
+        data = np.arange(20).reshape(4, 5)[::2, 1::2]
+        data2 = PreEncoder(default_encode_settings).encode(data)
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        assert (data == data3).all()
+        assert data3.flags.writeable
+    tests.append((test_np_non_contiguous, 'Encode non-contiguous numpy array'))
+
+    def test_stream():
+        shared = ['x']
+        data = [1, {'a': shared, 'b': (1, 2)}, shared, None]
+        data[1]['self'] = data
+        data_np = np.array({123: None})
+        data_np[()][123] = data_np  # circular through a custom decoder
+        for fmt in ('jsonl', 'prefixed'):
+            f = io.BytesIO()
+            encoder = StreamEncoder(default_encode_settings, f, fmt)
+            encoder.encode(data)
+            encoder.encode(data_np)
+            encoder.encode(123)
+            f.seek(0)
+            data3 = list(
+                StreamDecoder(default_decode_settings).iter_decode(f, fmt))
+            assert len(data3) == 3
+            assert data3[0][1]['self'] is data3[0]
+            assert data3[0][1]['a'] is data3[0][2]
+            assert data3[0][1]['b'] == (1, 2)
+            assert data3[1][()][123] is data3[1]
+            assert data3[2] == 123
+        records = []
+        StreamEncoder(default_encode_settings,
+            record_callback=records.append).encode(data)
+        # Post-order: children first, the root comes last
+        assert records[-1][0] == 0
+        assert ['fwd', 0, 'list'] in records
+    tests.append((test_stream, 'Stream encode/decode'))
+
+    def test_binary():
+        data = [0, -1, -100, 300, 2 ** 64 - 1, -2 ** 70, 1.5, True, None,
+            u'h\xe9llo', b'\x00\xff', (1, 2), {'a': [1]}, np.arange(10.),
+            np.array({1: 2})]
+        data.append(data)
+        payload = binary.dumps(data, default_encode_settings)
+        assert isinstance(payload, bytes)
+        # Native bytes/str, no escaping or prefixes
+        assert u'h\xe9llo'.encode('utf8') in payload
+        assert np.arange(10.).tobytes() in payload
+        data3 = binary.loads(payload, default_decode_settings)
+        assert data3[-1] is data3
+        for item, item3 in zip(data[:13], data3[:13]):
+            assert item == item3 and type(item) == type(item3)
+        assert (data3[13] == data[13]).all()
+        assert data3[14] == data[14]
+        # Arrays are views onto the payload
+        data3 = binary.loads(bytearray(payload), default_decode_settings)
+        assert data3[13].base is not None
+        data3[13][0] = 5.
+    tests.append((test_binary, 'Binary backend'))
+
+    def test_bytes_strategies():
+        rng = np.random.RandomState(0)
+        blobs = [b'', b'"\\\n\x7f', b'plain text ' * 10, bytes(bytearray(
+            range(256))), rng.bytes(1000), rng.bytes(3 << 20),
+            b'mostly text\x00' * 300000]
+        for blob in blobs:
+            # The estimate picks what comparing the JSON lengths would pick
+            # (sampled for the large blobs)
+            assert encode_bytes(blob) == encode_bytes(blob, 'exact')
+            for strategy in bytes_strategies:
+                if strategy == 'base85' and str_mode == 'bytes':
+                    continue  # python 3 only
+                encoder = bytes_encoder(strategy, sample_threshold=100)
+                assert decode_bytes(encoder(blob)[0]) == blob
+        assert encode_bytes(b'text', 'base64')[0][0] == 1
+    tests.append((test_bytes_strategies, 'Bytes encoding strategies'))
+
+    def test_intern_values():
+        # Equal but distinct strings, as a parser would produce them
+        data = [{''.join(['ke', 'y']): ''.join(['val', 'ue']), 'n': k}
+            for k in range(100)]
+        data += [(1,), (1.0,), (True,), (0.0,), (-0.0,), (1,)]
+        n_plain = len(PreEncoder(default_encode_settings).encode(data))
+        data2 = PreEncoder(default_encode_settings,
+            intern_values=True).encode(data)
+        assert len(data2) < n_plain - 150
+        s_prefix = 'b' if str_mode == 'bytes' else 'u'
+        assert data2.count(s_prefix + 'key') == 1
+        assert data2.count(s_prefix + 'value') == 1
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        assert data3 == data
+        assert [type(item[0]) for item in data3[-6:]] == [
+            int, float, bool, float, float, int]
+        assert str(data3[-2][0]) == '-0.0'
+        assert data3[-6] is data3[-1]
+        # Tuples of equal frozensets holding other types
+        data = [(frozenset([1]),), (frozenset([1.0]),),
+            (frozenset([True, 0]),), (frozenset([1, False]),)]
+        data3 = PostDecoder(registry.default_decode_settings).decode(
+            PreEncoder(registry.default_encode_settings,
+                intern_values=True).encode(data))
+        assert [sorted(map(type, item[0]), key = str) for item in data3] == [
+            [int], [float], [bool, int], [bool, int]]
+        assert [(k, type(k)) for k in sorted(data3[3][0])] == [
+            (False, bool), (1, int)]
+        # Read-only arrays by content, writable arrays never
+        arrays = [np.arange(5), np.arange(5), np.arange(5), np.arange(5)]
+        arrays[0].flags.writeable = arrays[1].flags.writeable = False
+        encoder = PreEncoder(default_encode_settings,
+            intern_values=(np.ndarray,))
+        data3 = PostDecoder(default_decode_settings).decode(
+            encoder.encode(arrays))
+        assert data3[0] is data3[1]
+        assert not data3[2] is data3[3]
+        # Bounded table
+        encoder = PreEncoder(intern_values=True, intern_max=10)
+        encoder.encode([str(k) for k in range(100)])
+        assert len(encoder.interned) <= 10
+    tests.append((test_intern_values, 'Intern equal values'))
+
+    def test_compact_dicts():
+        data = {1: 2, 'a': [3], (4,): {}}
+        data2 = PreEncoder(default_encode_settings,
+            compact_dicts=True).encode(data)
+        assert data2[0] == ['py/{}', 1, 2, [1], [2], [3], [5]]
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        assert data3 == data
+        # Empty dicts in the default layout decode as dicts too
+        assert PostDecoder().decode(PreEncoder().encode({})) == {}
+        # Circular, through keys and values
+        data = [{}]
+        data[0]['self'] = data
+        data[0][(1, 2)] = data[0]
+        for compact_dicts in (False, True):
+            data2 = PreEncoder(default_encode_settings,
+                compact_dicts=compact_dicts).encode(data)
+            data3 = PostDecoder(default_decode_settings).decode(data2)
+            assert data3[0]['self'] is data3
+            assert data3[0][(1, 2)] is data3[0]
+            f = io.BytesIO()
+            StreamEncoder(default_encode_settings, f,
+                compact_dicts=compact_dicts).encode(data)
+            f.seek(0)
+            data3 = StreamDecoder(default_decode_settings).decode(f)
+            assert data3[0]['self'] is data3
+            assert data3[0][(1, 2)] is data3[0]
+            data3 = binary.loads(binary.dumps(data, default_encode_settings,
+                compact_dicts=compact_dicts), default_decode_settings)
+            assert data3[0]['self'] is data3
+    tests.append((test_compact_dicts, 'Compact dict layout'))
+
+    def test_subclasses():
+        Point = collections.namedtuple('Point', 'x y')
+        class MyList(list): pass
+        class MyStr(str): pass
+        defaults = collections.defaultdict(list)
+        defaults['a'].append(1)
+        data = [Point(1, 2), MyList([3]), MyStr('s'), defaults,
+            collections.OrderedDict([('b', 2), ('a', 1)]),
+            np.int64(5), np.float32(0.5), np.bool_(True)]
+        data2 = PreEncoder(default_encode_settings).encode(data)
+        data3 = PostDecoder(default_decode_settings).decode(data2)
+        assert data3 == [(1, 2), [3], 's', {'a': [1]}, {'b': 2, 'a': 1},
+            5, 0.5, True]
+        assert type(data3[5]) is int and type(data3[7]) is bool
+        # The closest registered type wins
+        settings = dict(default_encode_settings)
+        settings[collections.OrderedDict] = ('odict',
+            lambda obj: (list(obj.items()), None))
+        data2 = PreEncoder(settings).encode(data)
+        assert data2[data2[0][4][0]][0] == 'py/odict'
+    tests.append((test_subclasses, 'Encode subclasses'))
+
+    def test_tag_spellings():
+        data3 = PostDecoder(default_decode_settings).decode(
+            [[b'py/tuple', 1], [[2], [3]], [u'py/'], [u'py/tuple', 4],
+            [5]])
+        assert data3 == ({}, (5,))
+        try:
+            PostDecoder(default_decode_settings).decode([['py/nope', 1], 2])
+        except Exception as e:
+            assert 'py/nope' in str(e)
+        else:
+            assert False
+        # Same encoded list decoded twice: fresh objects, cached tags
+        decoder = PostDecoder(default_decode_settings)
+        data2 = PreEncoder(default_encode_settings).encode([(1,), {2: [3]}])
+        data3 = decoder.decode(data2)
+        deserializers = decoder.deserializers
+        data4 = decoder.decode(data2)
+        assert decoder.deserializers is deserializers
+        assert data3 == data4 and not data3[1] is data4[1]
+    tests.append((test_tag_spellings, 'Decode tag spellings'))
+
+    def test_lazy():
+        shared = {'x': 1}
+        data = {'meta': {'version': 3}, 'a': [shared, shared, (1, [2])],
+            'big': [[k] for k in range(100)], 'arr': np.arange(3)}
+        data['a'].append(data['a'])
+        data2 = PreEncoder(default_encode_settings).encode(data)
+        decoder = LazyDecoder(default_decode_settings)
+        data3 = decoder.decode(data2)
+        assert data3['meta']['version'] == 3
+        # Only the root's items and the path to 'version' got decoded; custom
+        # objects (the array) are decoded whole
+        assert sum(decoder.done) < 30 < len(data2)
+        a = data3['a']
+        assert a[0] is a[1] and a[3] is a
+        assert a[2] == (1, [2]) and a[0] == {'x': 1}
+        assert (data3['arr'] == np.arange(3)).all()
+        assert data3['big'] == data['big']
+        assert len(data3) == 4 and sorted(data3.keys()) == sorted(data.keys())
+        # Same graph when decoding eagerly
+        for compact_dicts in (False, True):
+            data2 = PreEncoder(default_encode_settings,
+                compact_dicts=compact_dicts).encode([{'a': [1]}, (2,)])
+            data3 = LazyDecoder(default_decode_settings).decode(data2)
+            assert data3 == PostDecoder(default_decode_settings).decode(data2)
+    tests.append((test_lazy, 'Lazy decoding'))
+
+    def test_compression():
+        data = [np.zeros((300, 200)), np.arange(10), np.random.bytes(1 << 17),
+            b'abc' * 50000]
+        for codec in compression_codecs:
+            settings = dict(default_encode_settings)
+            settings[np.ndarray] = ('np_ndarray', np_ndarray_encoder(codec,
+                min_size = 1000, chunk_size = 100000))
+            settings[bytes] = ('bytes', bytes_encoder(compression = codec,
+                min_size = 1000))
+            decode_settings = dict(default_decode_settings)
+            decode_settings['bytes'] = (decode_bytes, None)
+            data2 = PreEncoder(settings).encode(data)
+            # Codec and chunk table are in the params; small and incompressible
+            # data is stored as is
+            assert len(data2) < 100
+            assert sum(1 for slot in data2
+                if slot in ('ucompression', 'bcompression')) == 1
+            data3 = PostDecoder(decode_settings).decode(data2)
+            assert (data3[0] == data[0]).all() and data3[0].flags.writeable
+            assert (data3[1] == data[1]).all() and data3[2:] == data[2:]
+            data3 = binary.loads(binary.dumps(data, settings), decode_settings)
+            assert (data3[0] == data[0]).all() and data3[3] == data[3]
+            assert len(binary.dumps(data[:1], settings)) < 100000
+        # A forked child compresses in a pool of its own (the parent's pool,
+        # started above, has no threads there)
+        if hasattr(os, 'fork'):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    PreEncoder(settings).encode(data[0])
+                    os._exit(0)
+                except BaseException:
+                    os._exit(1)
+            for k in range(300):
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done == pid:
+                    assert status == 0
+                    break
+                time.sleep(0.1)
+            else:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                assert False, 'compression hangs in a forked child'
+    tests.append((test_compression, 'Compress array and bytes data'))
+
+    def test_container():
+        big = np.arange(100000, dtype = np.float32).reshape(100, 1000)
+        data = {'meta': {'version': 1}, 'arrays': [big, big.T, np.arange(3)],
+            'blob': b'x' * 10000, 'zeros': np.zeros(100000)}
+        settings = dict(default_encode_settings)
+        settings[bytes] = ('bytes', bytes_encoder('buffer'))
+        settings[np.ndarray] = ('np_ndarray', np_ndarray_encoder(
+            min_size = 500000, dtype_kinds = 'f', chunk_size = 1 << 16))
+        decode_settings = dict(default_decode_settings)
+        decode_settings['bytes'] = (decode_bytes, None)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            container.dump_file(data, path, settings)
+            data3 = container.load(path, decode_settings)
+            arrays = data3['arrays']
+            assert (arrays[0] == big).all() and (arrays[1] == big.T).all()
+            assert arrays[0] is not arrays[1] and (arrays[2] == range(3)).all()
+            assert data3['blob'] == data['blob']
+            assert (data3['zeros'] == 0).all() and data3['zeros'].flags.writeable
+            # Views onto the page-aligned mapping
+            assert not arrays[0].flags.writeable and not arrays[0].flags.owndata
+            assert arrays[0].ctypes.data % container.data_alignment == 0
+            data3 = container.load(path, decode_settings, writable = True)
+            data3['arrays'][0][0, 0] = 5
+            assert container.load(path, decode_settings)['arrays'][0][0, 0] == 0
+            data3 = container.load(path, decode_settings, lazy = True)
+            assert data3['meta']['version'] == 1
+            del data3, arrays
+            # The string format is recorded in the file
+            container.dump_file(data, path, settings, string_format = 'native')
+            data3 = container.load(path, decode_settings)
+            assert data3['blob'] == data['blob'] and data3['meta'] == data['meta']
+            assert (data3['arrays'][0] == big).all()
+            try:
+                container.load(path, decode_settings, string_format = 'prefixed')
+            except Exception as e:
+                assert 'native' in str(e)
+            else:
+                assert False
+            del data3
+        finally:
+            os.remove(path)
+    tests.append((test_container, 'Container file'))
+
+    def test_stats():
+        shared = [1, 2]
+        data = {'a': [shared, shared, (3, [4])], 'b': np.arange(5), 'c': 'x'}
+        slots = []
+        stats = EncodeStats(slot_callback = lambda idx, obj: slots.append(idx))
+        data2 = PreEncoder(default_encode_settings, stats = stats).encode(data)
+        assert data2 == PreEncoder(default_encode_settings).encode(data)
+        summary = stats.summary()
+        # The array's shape is a tuple too
+        assert summary['type_counts']['tuple'] == 2
+        assert summary['codec_calls'] == {'tuple': 2, 'np_ndarray': 1}
+        assert summary['codec_size']['np_ndarray'] > 40
+        assert stats.hits == 1 and 0 < stats.hit_rate() < 1
+        assert stats.max_depth >= 3 and len(set(slots)) == len(slots)
+        # Reused for another encoder: counts add up, the id tables do not
+        a = ['y']
+        data4 = PreEncoder(stats = stats).encode(['x', a[0]])
+        assert PostDecoder().decode(data4) == ['x', 'y']
+        assert stats.hits == 1 and stats.lookups > summary['lookups']
+        stats = DecodeStats()
+        data3 = PostDecoder(default_decode_settings, stats = stats).decode(data2)
+        assert data3['a'][0] is data3['a'][1]
+        summary = stats.summary()
+        assert summary['kind_counts']['py/tuple'] == 2
+        assert summary['kind_counts']['dict'] == 1
+        assert summary['codec_calls'] == {'py/tuple': 2, 'py/np_ndarray': 1}
+    tests.append((test_stats, 'Encoder/decoder statistics'))
+
+    def test_session():
+        encoder = SessionEncoder(default_encode_settings, max_strings = 6)
+        decoder = SessionDecoder(default_decode_settings, max_strings = 6)
+        messages = [{'method': 'get', 'id': k, 'args': ('key', k)}
+            for k in range(3)]
+        messages += ['method', 'x' * 100, [b'key', u'key'], {'id': None}]
+        sizes = []
+        for data in messages:
+            message = encoder.encode(data)
+            sizes.append(len(str(message)))
+            assert decoder.decode(json.loads(json.dumps(message))) == data
+        assert sizes[1] < sizes[0] and len(encoder.strings) == 6
+        # The root can be a session string; long strings are not shared
+        assert encoder.encode('method')[2] == ['umethod']
+        assert not 'u' + 'x' * 100 in encoder.strings
+        encoder.reset()
+        assert decoder.decode(encoder.encode(messages[0])) == messages[0]
+        assert len(decoder.session_raws) == len(encoder.strings) < 6
+        # Larger messages after the table has strings; nothing is kept of them
+        data = [[u'method', 'id', k, list(range(k))] for k in range(50)]
+        assert decoder.decode(encoder.encode(data)) == data
+        assert decoder.decode(encoder.encode(data[:2])) == data[:2]
+        assert decoder.raws[:decoder.capacity] == [None] * decoder.capacity
+        # Lost messages are detected
+        encoder.encode(['new string'])
+        try:
+            decoder.decode(encoder.encode(messages[1]))
+        except Exception as e:
+            assert 'out of sync' in str(e)
+        else:
+            assert False
+    tests.append((test_session, 'Session string table'))
+
+    def test_packed_lists():
+        floats = [k * 0.5 for k in range(100)]
+        ints = list(range(-50, 50))
+        data = [floats, ints, floats, [True] * 20, [1] * 19 + [1.0],
+            [2 ** 70] * 20, [0.5] * 3, {'x': ints}]
+        data2 = PreEncoder(packed_lists = True).encode(data)
+        assert len(data2) < 50
+        # Ints in the narrowest dtype, base64 text in-band
+        assert data2[1][:2] == ['py/[]', 0] and data2[3][:2] == ['py/[]', 2]
+        assert data2[data2[3][2][0]] == 'u' + base64.b64encode(
+            np.arange(-50, 50, dtype = np.int8).tobytes()).decode()
+        data3 = PostDecoder().decode(data2)
+        assert data3 == data and data3[0] is data3[2]
+        assert [type(x) for x in data3[4]] == [int] * 19 + [float]
+        assert type(data3[3][0]) is bool and type(data3[1][0]) is int
+        f = io.BytesIO()
+        StreamEncoder({}, f, packed_lists = True).encode(data)
+        f.seek(0)
+        assert StreamDecoder().decode(f) == data
+        assert binary.loads(binary.dumps(data, packed_lists = True)) == data
+        buffers = []
+        data2 = PreEncoder(packed_lists = True,
+            buffer_callback = buffers.append).encode(data)
+        assert PostDecoder(buffers = buffers).decode(data2) == data
+        assert [len(buf) for buf in buffers] == [800, 100]
+        # Smaller json than plain lists
+        for data in ([k % 1000 for k in range(1000)], [2 ** 40] * 100,
+                [k / 7. for k in range(1000)]):
+            payload = json.dumps(PreEncoder(packed_lists = True).encode(data))
+            assert len(payload) < len(json.dumps(PreEncoder().encode(data)))
+            assert PostDecoder().decode(json.loads(payload)) == data
+    tests.append((test_packed_lists, 'Packed numeric lists'))
+
+    def test_aio():
+        if aio is None:
+            return
+        data = [{'a': np.arange(100000), 'b': [1, 2]}, (3, 'x'), 'last']
+        data[0]['self'] = data[0]
+        for fmt in ('jsonl', 'prefixed'):
+            f = io.BytesIO()
+            encoder = StreamEncoder(default_encode_settings, f, fmt)
+            for obj in data:
+                encoder.encode(obj)
+            payload = f.getvalue()
+            async def decode_all():
+                reader = asyncio.StreamReader()
+                decoder = aio.AsyncStreamDecoder(default_decode_settings,
+                    offload_min = 10000)
+                # Bytes arrive in small pieces, after decoding started
+                async def feed():
+                    for k in range(0, len(payload), 30000):
+                        reader.feed_data(payload[k:k + 30000])
+                        await asyncio.sleep(0)
+                    reader.feed_eof()
+                task = asyncio.ensure_future(feed())
+                first = await decoder.decode(reader, fmt)
+                rest = [obj async for obj in decoder.iter_decode(reader, fmt)]
+                await task
+                return [first] + rest
+            loop = asyncio.new_event_loop()
+            try:
+                data3 = loop.run_until_complete(decode_all())
+            finally:
+                loop.close()
+            assert (data3[0]['a'] == data[0]['a']).all()
+            assert data3[0]['self'] is data3[0]
+            assert data3[1:] == data[1:]
+        # A message of many small records, all read at once, still lets other
+        # tasks run while it is decoded
+        data = [{'id': k, 'name': 'n%d' % k} for k in range(20000)]
+        f = io.BytesIO()
+        StreamEncoder({}, f).encode(data)
+        payload = f.getvalue()
+        async def decode_with_ticker():
+            reader = asyncio.StreamReader(limit = len(payload) + 1)
+            reader.feed_data(payload)
+            reader.feed_eof()
+            decoding = [True]
+            ticks = [0]
+            async def ticker():
+                while decoding[0]:
+                    ticks[0] += 1
+                    await asyncio.sleep(0)
+            task = asyncio.ensure_future(ticker())
+            await asyncio.sleep(0)
+            ticks[0] = 0
+            obj = await aio.AsyncStreamDecoder(yield_bytes = 1 << 14).decode(
+                reader)
+            decoding[0] = False
+            await task
+            return obj, ticks[0]
+        loop = asyncio.new_event_loop()
+        try:
+            data3, ticks = loop.run_until_complete(decode_with_ticker())
+        finally:
+            loop.close()
+        assert data3 == data
+        assert ticks >= len(payload) // (1 << 15)  # about one per 16 kB
+    tests.append((test_aio, 'Asyncio stream decoding'))
+
+    def test_shm():
+        if shm is None:
+            return
+        data = {'a': np.arange(1000.), 'b': [np.ones((3, 4), np.int8)] * 2,
+            'c': 'text'}
+        with shm.ShmEncoder(default_encode_settings) as encoder:
+            message = encoder.encode(data)
+            assert encoder.encode([1, 'x'])[0] is None  # no buffers, no segment
+            message2 = encoder.encode([np.zeros(0), np.zeros((2, 0), np.int8)])
+            assert message2[0] is None  # only empty buffers, no segment
+            data4 = shm.ShmDecoder(default_decode_settings).decode(message2)
+            assert data4[0].shape == (0,) and data4[1].shape == (2, 0)
+            assert data4[1].dtype == np.int8
+            # The string format comes with the message
+            with shm.ShmEncoder(default_encode_settings,
+                    string_format = 'native') as native:
+                message2 = native.encode([u'uu', b'bob', u'user', np.arange(3)])
+                with shm.ShmDecoder(default_decode_settings, track = True) as d:
+                    data4 = d.decode(message2)
+                    assert data4[:3] == [u'uu', b'bob', u'user']
+                    assert (data4[3] == range(3)).all()
+                    del data4
+            # Same process, so encoder and decoder share the resource tracker
+            decoder = shm.ShmDecoder(default_decode_settings, track = True)
+            data3 = decoder.decode(message)
+            encoder.release(message)
+            assert not encoder.segments
+        # Views onto the (unlinked but still attached) segment
+        assert (data3['a'] == data['a']).all() and not data3['a'].flags.owndata
+        assert data3['b'][0] is data3['b'][1] and data3['c'] == 'text'
+        data3['a'][0] = 5
+        try:
+            decoder.release(message)
+        except Exception as e:
+            assert 'still in use' in str(e)
+        else:
+            assert False
+        del data3
+        decoder.close()
+        assert not decoder.segments
+        try:
+            shm.shared_memory.SharedMemory(message[0])
+        except FileNotFoundError:
+            pass
+        else:
+            assert False
+    tests.append((test_shm, 'Shared memory transport'))
+
+    def test_dict_templates():
+        rows = [{'id': k, 'name': 'n%d' % k, 'score': k * 0.5} for k in range(50)]
+        rows.append({1: 'a', 2: 'b'})
+        rows.append({True: 'a', 2: 'b'})  # same keys by ==, other types
+        rows.append({0.0: 'a'})
+        rows.append({-0.0: 'b'})
+        rows.append({})
+        data2 = PreEncoder(dict_templates = True).encode(rows)
+        assert len(data2) < len(PreEncoder().encode(rows)) // 2
+        data3 = PostDecoder().decode(data2)
+        assert data3 == rows and list(data3[0]) == list(rows[0])
+        assert type(list(data3[-4])[0]) is bool
+        assert [str(list(_)[0]) for _ in data3[-3:-1]] == ['0.0', '-0.0']
+        # Type differs inside a tuple key
+        data = [{(1,): 'a'}, {(1.0,): 'b'}]
+        data3 = PostDecoder(default_decode_settings).decode(PreEncoder(
+            default_encode_settings, dict_templates = True).encode(data))
+        assert [type(list(_)[0][0]) for _ in data3] == [int, float]
+        assert binary.loads(binary.dumps(rows, dict_templates = True)) == rows
+        assert LazyDecoder().decode(data2)[5]['name'] == 'n5'
+        # Circular, through a template's values
+        data = [{'a': 1}, {'a': 2}]
+        data[1]['a'] = data
+        data2 = PreEncoder(dict_templates = True).encode(data)
+        data3 = PostDecoder().decode(data2)
+        assert data3[1]['a'] is data3 and data3[0] == {'a': 1}
+        f = io.BytesIO()
+        StreamEncoder({}, f, dict_templates = True).encode(data)
+        f.seek(0)
+        data3 = StreamDecoder().decode(f)
+        assert data3[1]['a'] is data3 and data3[0] == {'a': 1}
+        assert LazyDecoder().decode(data2)[1]['a'][1]['a'][0]['a'] == 1
+    tests.append((test_dict_templates, 'Dict templates'))
+
+    def test_registry():
+        # Neither importing the package nor building the defaults imports numpy
+        # or the compression modules
+        out = subprocess.check_output([sys.executable, '-c',
+            'import sys; from p23serialize import registry; '
+            'print([m for m in ("numpy", "zlib", "bz2", "lzma") '
+            'if m in sys.modules])'],
+            cwd = os.path.dirname(os.path.abspath(__file__)))
+        assert out.strip() == b'[]'
+        data = [(1, 2), np.arange(3.), b'\x00\xff', set([1, 'a']),
+            frozenset([(1, 2)]), datetime.datetime(2020, 2, 29, 23, 59, 1, 5),
+            np.float32(0.5)]
+        if hasattr(datetime, 'timezone'):
+            data.append(datetime.datetime(2020, 1, 1, 12, tzinfo =
+                datetime.timezone(datetime.timedelta(hours = -5))))
+        data2 = PreEncoder(registry.default_encode_settings).encode(data)
+        data2 = json.loads(json.dumps(data2))
+        data3 = PostDecoder(registry.default_decode_settings).decode(data2)
+        assert (data3[1] == data[1]).all()
+        assert data3[:1] + data3[2:] == data[:1] + data[2:]
+        assert [type(_) for _ in data3[3:5]] == [set, frozenset]
+        if len(data) > 7:
+            assert data3[7].utcoffset() == data[7].utcoffset()
+        # Codecs can be picked by name; the unicode codec is opt-in
+        settings = registry.encode_settings(['tuple', 'unicode'])
+        data2 = PreEncoder(settings).encode([u'text', (1,)])
+        data3 = PostDecoder(registry.default_decode_settings).decode(data2)
+        assert data3 == [u'text', (1,)]
+    tests.append((test_registry, 'Codec registry and lazy imports'))
+
+    def test_native_strings():
+        text = u'text \u20ac'
+        data = [text, b'\xff\x00raw', {b'k': u'v', u'k': b'v'}, text,
+            (u'a', b'a'), bytes_encoder('buffer')(b'blob')[0][1]]
+        encoder = PreEncoder(default_encode_settings, string_format = 'native')
+        data2 = encoder.encode(data)
+        # Text is stored as is, the last slot lists the bytes slots
+        assert data2[1] is text
+        assert [data2[k] for k in data2[-1]] == [
+            u'\xff\x00raw', u'k', u'v', u'a', u'blob']
+        data2 = json.loads(json.dumps(data2))
+        decoder = PostDecoder(default_decode_settings, string_format = 'native')
+        data3 = decoder.decode(data2)
+        assert data3[:5] == data[:5] and data3[5] == b'blob'
+        assert [type(_) for _ in data3[4]] == [type(u''), bytes]
+        assert data3[0] is data3[3]
+        assert LazyDecoder(default_decode_settings,
+            string_format = 'native').decode(data2)[2] == data[2]
+        for root in (b'\x80', u'x', 1):
+            data2 = PreEncoder(string_format = 'native').encode(root)
+            data3 = PostDecoder(string_format = 'native').decode(data2)
+            assert data3 == root and type(data3) is type(root)
+        try:
+            StreamEncoder({}, io.BytesIO(), string_format = 'native')
+        except Exception as e:
+            assert 'prefixed' in str(e)
+        else:
+            assert False
+    tests.append((test_native_strings, 'Native string format'))
+
+    def test_parallel():
+        if parallel is None:
+            return
+        data = [{'id': k, 'name': 'n%d' % k, 'a': np.arange(k % 5), 't': (k,),
+            's': set([k])} for k in range(1500)]
+        data[7] = 1.5
+        shared = [1, 2]
+        data[10]['shared'] = data[1400]['shared'] = shared
+        data[20]['self'] = data[20]
+        settings = registry.default_encode_settings
+        for string_format in ('prefixed', 'native'):
+            data2 = parallel.encode(data, settings, processes = 2,
+                chunk_size = 100, string_format = string_format)
+            data2 = json.loads(json.dumps(data2))
+            for data3 in (
+                    PostDecoder(registry.default_decode_settings,
+                        string_format = string_format).decode(data2),
+                    parallel.decode(data2, registry.default_decode_settings,
+                        processes = 2, chunk_size = 100,
+                        string_format = string_format)):
+                assert len(data3) == len(data) and data3[7] == 1.5
+                assert all(a['name'] == b['name'] and a['t'] == b['t']
+                    and a['s'] == b['s'] and (a['a'] == b['a']).all()
+                    for a, b in zip(data[8:], data3[8:]))
+                assert data3[10]['shared'] is data3[1400]['shared']
+                assert data3[20]['self'] is data3[20]
+        # Serially encoded tables with shared dict templates decode too
+        data2 = PreEncoder(settings, dict_templates = True).encode(data)
+        data3 = parallel.decode(data2, registry.default_decode_settings,
+            processes = 2, chunk_size = 100)
+        assert data3[10]['shared'] is data3[1400]['shared']
+        assert [_['id'] for _ in data3[8:]] == [_['id'] for _ in data[8:]]
+        # Without the check, shared slots are copied per chunk
+        data3 = parallel.decode(data2, registry.default_decode_settings,
+            processes = 2, chunk_size = 100, check_shared = False)
+        assert data3[10]['shared'] == data3[1400]['shared'] == shared
+        assert not data3[10]['shared'] is data3[1400]['shared']
+        assert [_['id'] for _ in data3[8:]] == [_['id'] for _ in data[8:]]
+        # Sharing through subclasses of the containers is found too
+        Pair = collections.namedtuple('Pair', 'a b')
+        data[30] = {'od': collections.OrderedDict([('x', shared)])}
+        data[1300] = Pair(shared, 1)
+        data3 = PostDecoder(registry.default_decode_settings).decode(
+            parallel.encode(data, settings, processes = 2, chunk_size = 100))
+        assert data3[30]['od']['x'] is data3[1300][0] is data3[10]['shared']
+        # Items referring back to the list are encoded in one piece, also
+        # through a subclass
+        data[1450] = collections.OrderedDict([('root', data)])
+        data2 = parallel.encode(data, settings, processes = 2, chunk_size = 100)
+        assert len(data2) == len(PreEncoder(settings).encode(data))
+        data3 = PostDecoder(registry.default_decode_settings).decode(data2)
+        assert data3[1450]['root'] is data3
+        data[1450] = {}
+        data.append(data)
+        data3 = PostDecoder(registry.default_decode_settings).decode(
+            parallel.encode(data, settings, processes = 2, chunk_size = 100))
+        assert data3[-1] is data3
+        # Types the check cannot look into are encoded in one piece
+        assert parallel.shared_groups([collections.deque()] * 2,
+            [(0, 1), (1, 2)]) is None
+        assert parallel.shared_groups([np.arange(2)] * 2, [(0, 1), (1, 2)]) == [
+            [0, 1]]
+    tests.append((test_parallel, 'Parallel encode/decode'))
+
 
     # test09: encode unknown type (must fail in specific way)
     # TODO: tests between python2/3 and bytes/str/unicode